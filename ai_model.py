@@ -11,6 +11,7 @@ We:
   • Train a GCN to get embeddings
   • Combine GCN embeddings + handcrafted => CCV
   • Cross-validate with both MLP and QSup, logging losses & generating plots
+  • Optionally search a QSup hyperparameter grid (QSUP_GRID) over the CV folds, trained as one batched ensemble
 
 Important changes:
   • Removed in-place ops (+=, *=, etc.) in QSupFullNet so that 
@@ -25,9 +26,8 @@ import os
 import glob
 import json
 import time
+import itertools
 import numpy as np
-import pandas as pd
-import mne
 import networkx as nx
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -48,19 +48,50 @@ from torch_geometric.data import Data, DataLoader as PyGDataLoader
 from torch_geometric.nn import GCNConv, global_mean_pool
 from torch.utils.tensorboard import SummaryWriter
 
+from feature_store import EpochStore, load_feature_bundle, load_manifest, params_fingerprint
+from catalog import Catalog
+from montage import distance_graph, gcn_normalize
+
 #############################################
 # PATHS & DIRECTORIES (Update as needed)
 #############################################
 HANDCRAFTED_DIR = "processed_features/handcrafted"
 GNN_DIR         = "processed_features/gnn"
 CHANNELS_DIR    = "processed_features/channels"
+EPOCHS_DIR      = "processed_features/epochs"
+BUNDLE_PATH     = "processed_features/features.bundle"  # written by process_server.py
+MANIFEST_PATH   = "processed_features/manifest.json"
+GRAPH_CACHE_DIR = "processed_features/graph_cache"  # distance graphs per channel list
+
+# PSD backend server.py computes the live band powers with (EEG_PSD_METHOD there);
+# training refuses features extracted with another one
+PSD_METHOD      = os.environ.get("EEG_PSD_METHOD", "multitaper")
+
+# GCN engine: "dense" stacks all subjects into (n_subjects, n_nodes, n_features)
+# and runs each layer as a batched matmul with the normalised adjacency;
+# "pyg" collates sparse graphs with the PyG DataLoader; "auto" is dense when
+# every graph has the same number of nodes.
+GCN_ENGINE      = "auto"
+
+# QSup hyperparameter grid, trained over all CV folds as one ensemble in main() (None: skip),
+# e.g. {"num_wavefunctions": [2, 3, 4], "topk": [0, 8, 16], "partial_norm": [1.0, 1.5]}
+QSUP_GRID       = None
 PLOTS_DIR       = "plots"
 LOG_DIR         = "logs"
-for d in [PLOTS_DIR, LOG_DIR]:
+MODELS_DIR      = "models"  # TorchScript QSup fold models (export_qsup)
+for d in [PLOTS_DIR, LOG_DIR, MODELS_DIR]:
     os.makedirs(d, exist_ok=True)
 
-PARTICIPANTS_FILE_DS004504 = "/Users/ishaangubbala/Documents/SF/ds004504/participants.tsv"
-PARTICIPANTS_FILE_DS003800 = "/Users/ishaangubbala/Documents/SF/ds003800/participants.tsv"
+CATALOG_PATH    = "processed_features/catalog.sqlite"  # shared with process_server.py
+
+# GCN edges: "plv" / "coherence" use the per-subject connectivity saved by
+# process_server.py (mean over EDGE_BANDS, None = all bands), keeping the
+# EDGE_DENSITY strongest channel pairs as weighted edges; "distance" (or a
+# subject without connectivity files) uses the montage distance graph.
+# Connectivity edges are opt-in: they change the graphs and so the results.
+EDGE_MEASURE    = "distance"
+EDGE_BANDS      = None
+EDGE_DENSITY    = 0.3
 
 #############################################
 # 1) ENABLE ANOMALY DETECTION
@@ -70,29 +101,60 @@ torch.autograd.set_detect_anomaly(True)
 #############################################
 # 2) LOAD PARTICIPANT LABELS
 #############################################
-def load_participant_labels(ds004504_file, ds003800_file):
-    label_dict = {}
-    group_map_ds004504 = {"A": 1, "C": 0}
-    df_ds004504 = pd.read_csv(ds004504_file, sep="\t")
-    df_ds004504 = df_ds004504[df_ds004504['Group'] != 'F']
-    df_ds004504 = df_ds004504[df_ds004504['Group'].isin(group_map_ds004504.keys())]
-    labels_ds004504 = df_ds004504.set_index("participant_id")["Group"].map(group_map_ds004504).to_dict()
-    label_dict.update(labels_ds004504)
-
-    df_ds003800 = pd.read_csv(ds003800_file, sep="\t")
-    labels_ds003800 = df_ds003800.set_index("participant_id")["Group"].apply(lambda x: 1).to_dict()
-    label_dict.update(labels_ds003800)
-    return label_dict
-
-participant_labels = load_participant_labels(
-    PARTICIPANTS_FILE_DS004504,
-    PARTICIPANTS_FILE_DS003800
-)
+# Labels come from the dataset catalog (group mapping in catalog.DATASETS)
+participant_labels = Catalog(CATALOG_PATH).participant_labels()
 
 #############################################
 # 3) LOAD SAVED FEATURE FILES
 #############################################
 def load_saved_features():
+    """
+    Features of every labelled subject: from the packed bundle (memory-mapped)
+    when process_server.py wrote one that is current, else from the
+    per-subject files.
+    """
+    bundle = load_current_bundle()
+    if bundle is not None:
+        check_psd_method(bundle["psd_method"], BUNDLE_PATH)
+        keep = [i for i, s in enumerate(bundle["subjects"]) if s in participant_labels]
+        if keep:
+            print(f"[INFO] Loaded {len(keep)} subjects from {BUNDLE_PATH}")
+            # Labels from the catalog, not the bundle: a relabelled participant is not re-extracted
+            labels = np.array([participant_labels[bundle["subjects"][i]] for i in keep], dtype=np.int32)
+            if len(keep) == len(bundle["subjects"]):  # the usual case: stay a view of the map
+                X_handcrafted = bundle["handcrafted"]
+            else:
+                X_handcrafted = bundle["handcrafted"][keep]
+            return (X_handcrafted, [bundle["gnn"][i] for i in keep], labels,
+                    [bundle["ch_names"][i] for i in keep], [bundle["subjects"][i] for i in keep])
+    params = load_manifest(MANIFEST_PATH)["params"]
+    if params:  # manifests from before PSD_METHOD are multitaper
+        check_psd_method(params.get("psd_method", "multitaper"), MANIFEST_PATH)
+    return load_feature_files()
+
+def check_psd_method(method, source):
+    """Raise if the features in source were computed with another PSD backend than PSD_METHOD."""
+    if method != PSD_METHOD:
+        raise ValueError(f"Features in {source} were extracted with psd_method={method!r}, but the server "
+                         f"computes {PSD_METHOD!r} (EEG_PSD_METHOD); re-extract or set EEG_PSD_METHOD={method}.")
+
+def load_current_bundle():
+    """The feature bundle, or None if absent, older than the manifest or of other extraction parameters."""
+    if not os.path.exists(BUNDLE_PATH):
+        return None
+    if os.path.exists(MANIFEST_PATH):
+        if os.path.getmtime(BUNDLE_PATH) < os.path.getmtime(MANIFEST_PATH):
+            print(f"[WARNING] {BUNDLE_PATH} is older than {MANIFEST_PATH}; reading the per-subject files.")
+            return None
+        bundle = load_feature_bundle(BUNDLE_PATH)
+        if bundle["params_hash"] != params_fingerprint(load_manifest(MANIFEST_PATH)["params"]):
+            print(f"[WARNING] {BUNDLE_PATH} was written for other extraction parameters; "
+                  f"reading the per-subject files.")
+            return None
+        return bundle
+    return load_feature_bundle(BUNDLE_PATH)
+
+def load_feature_files():
     handcrafted_files = glob.glob(os.path.join(HANDCRAFTED_DIR, "*_handcrafted.npy"))
     X_handcrafted = []
     X_gnn = []
@@ -128,61 +190,123 @@ def load_saved_features():
     labels = np.array(labels, dtype=np.int32)
     return X_handcrafted, X_gnn, labels, ch_names_list, subj_ids
 
+def load_connectivity(subj_ids, measure=EDGE_MEASURE):
+    """(n_bands, n_channels, n_channels) connectivity of each subject, None where not saved."""
+    if measure == "distance":
+        return [None] * len(subj_ids)
+    conn_list = []
+    for subj_id in subj_ids:
+        conn_file = os.path.join(GNN_DIR, f"{subj_id}_{measure}.npy")
+        conn_list.append(np.load(conn_file) if os.path.exists(conn_file) else None)
+    return conn_list
+
+def load_epoch_features(family, subj_ids=None):
+    """
+    Per-epoch features of one family ("handcrafted" -> (n_epochs, n_features),
+    "gnn" -> (n_epochs, n_channels, n_bands)) for each subject.
+    Values are memmap views: nothing is read from disk until they are used.
+    """
+    store = EpochStore(EPOCHS_DIR)
+    if subj_ids is None:
+        subj_ids = store.subjects()
+    return {s: store.epochs(s, family) for s in subj_ids if s in store}
+
 #############################################
 # 4) GCN MODEL & DATASET
 #############################################
 class GCNNet(nn.Module):
     def __init__(self, in_channels, hidden_channels, num_classes):
         super(GCNNet, self).__init__()
-        self.conv1 = GCNConv(in_channels, hidden_channels)
-        self.conv2 = GCNConv(hidden_channels, hidden_channels)
+        # Edge weights arrive GCN-normalised (with self-loops) from create_pyg_dataset
+        self.conv1 = GCNConv(in_channels, hidden_channels, normalize=False)
+        self.conv2 = GCNConv(hidden_channels, hidden_channels, normalize=False)
         self.lin = nn.Linear(hidden_channels, num_classes)
 
-    def forward(self, x, edge_index, batch):
-        x = F.relu(self.conv1(x, edge_index))
-        x = F.relu(self.conv2(x, edge_index))
+    def forward(self, x, edge_index, batch, edge_weight=None):
+        x = F.relu(self.conv1(x, edge_index, edge_weight))
+        x = F.relu(self.conv2(x, edge_index, edge_weight))
         x = global_mean_pool(x, batch)
         logits = self.lin(x)
         return logits
 
-    def embed(self, x, edge_index, batch):
-        x = F.relu(self.conv1(x, edge_index))
-        x = F.relu(self.conv2(x, edge_index))
+    def embed(self, x, edge_index, batch, edge_weight=None):
+        x = F.relu(self.conv1(x, edge_index, edge_weight))
+        x = F.relu(self.conv2(x, edge_index, edge_weight))
         x = global_mean_pool(x, batch)
         return x
 
-def compute_adjacency_matrix(ch_names):
-    montage = mne.channels.make_standard_montage('standard_1020')
-    pos_dict = montage.get_positions()['ch_pos']
-    used = [ch for ch in ch_names if ch in pos_dict]
-    if not used:
-        return None
-    coords = np.array([pos_dict[ch] for ch in used])
-    from scipy.spatial.distance import pdist, squareform
-    D = squareform(pdist(coords))
-    threshold = np.percentile(D, 30)
-    A = (D < threshold).astype(np.float32)
-    np.fill_diagonal(A, 0)
-    return A
-
-def create_pyg_dataset(gnn_list, y, ch_names_list):
+    # Dense engine: x (n_graphs, n_nodes, in_channels), adj (n_nodes, n_nodes)
+    # shared by all graphs or (n_graphs, n_nodes, n_nodes); same weights as above.
+    def forward_dense(self, x, adj):
+        return self.lin(self.embed_dense(x, adj))
+
+    def embed_dense(self, x, adj):
+        x = F.relu(adj @ self.conv1.lin(x) + self.conv1.bias)
+        x = F.relu(adj @ self.conv2.lin(x) + self.conv2.bias)
+        return x.mean(dim=-2)
+
+def connectivity_adjacency(conn, bands=EDGE_BANDS, density=EDGE_DENSITY):
+    """
+    Weighted adjacency from (n_bands, n_channels, n_channels) connectivity:
+    the band mean, keeping the `density` fraction of strongest channel pairs.
+    """
+    W = conn[list(bands)] if bands is not None else conn
+    W = W.mean(axis=0).astype(np.float32)
+    np.fill_diagonal(W, 0)
+    off_diagonal = W[~np.eye(len(W), dtype=bool)]
+    threshold = np.quantile(off_diagonal, 1 - density)
+    return np.where(W >= threshold, W, 0).astype(np.float32)
+
+def create_pyg_dataset(gnn_list, y, ch_names_list, conn_list=None):
+    """
+    One graph per subject. With conn_list (see load_connectivity) the edges are
+    the subject's own strongest connectivity pairs, weighted by it; subjects
+    without connectivity fall back to the montage distance graph, which is
+    looked up per channel list (montage.distance_graph) rather than rebuilt.
+    Edge weights are GCN-normalised here, once, instead of in every forward.
+    """
     pyg_data_list = []
     for i in range(len(gnn_list)):
-        A = compute_adjacency_matrix(ch_names_list[i])
-        if A is None:
-            print(f"[WARNING] No valid adjacency for subject {i+1}.")
-            continue
-        edge_index = np.array(np.nonzero(A))
-        edge_index = torch.tensor(edge_index, dtype=torch.long)
-        x = torch.tensor(gnn_list[i], dtype=torch.float)
-        if x.shape[0] != A.shape[0]:
+        if len(gnn_list[i]) != len(ch_names_list[i]):
             print(f"[ERROR] Subject {i+1}: mismatch in node count.")
             continue
+        conn = conn_list[i] if conn_list is not None else None
+        if conn is not None:
+            edge_index, edge_weight = gcn_normalize(connectivity_adjacency(conn))
+            graph = {"nodes": np.arange(len(conn[0])), "edge_index": edge_index, "edge_weight": edge_weight}
+        else:
+            graph = distance_graph(ch_names_list[i], GRAPH_CACHE_DIR)
+        if graph is None:
+            print(f"[WARNING] No valid adjacency for subject {i+1}.")
+            continue
+        edge_index = torch.from_numpy(graph["edge_index"])
+        edge_weight = torch.from_numpy(graph["edge_weight"])
+        x = torch.tensor(np.asarray(gnn_list[i])[graph["nodes"]], dtype=torch.float)
         y_val = torch.tensor([y[i]], dtype=torch.long)
-        data_obj = Data(x=x, edge_index=edge_index, y=y_val)
+        data_obj = Data(x=x, edge_index=edge_index, edge_weight=edge_weight, y=y_val)
         pyg_data_list.append(data_obj)
     return pyg_data_list
 
+def create_dense_dataset(pyg_dataset):
+    """
+    The PyG graphs as dense tensors: x (n_graphs, n_nodes, n_features), the
+    normalised adjacency (n_nodes, n_nodes) when all graphs share it, else
+    (n_graphs, n_nodes, n_nodes), and y. None if node counts differ.
+    """
+    n_nodes = {d.num_nodes for d in pyg_dataset}
+    if len(n_nodes) != 1:
+        return None
+    n = n_nodes.pop()
+    adj = torch.zeros(len(pyg_dataset), n, n)
+    for i, d in enumerate(pyg_dataset):
+        # Messages flow source (row 0) -> target (row 1): out[target] += w * x[source]
+        adj[i, d.edge_index[1], d.edge_index[0]] = d.edge_weight
+    if torch.equal(adj, adj[:1].expand_as(adj)):
+        adj = adj[0]
+    x = torch.stack([d.x for d in pyg_dataset])
+    y = torch.cat([d.y for d in pyg_dataset])
+    return x, adj, y
+
 #############################################
 # 5) MLP Classification (Partial-Fit)
 #############################################
@@ -422,6 +546,250 @@ def train_qsup_full_tb(
     writer.close()
     return model, train_loss_history, val_loss_history
 
+class QSupFusedNet(nn.Module):
+    """
+    Inference form of a trained QSupFullNet, with the same outputs:
+      - all wavefunction layers packed into one weight => a single GEMM
+      - cos/sin of the phases computed once, rotation vectorised over wavefunctions
+      - top-k normalisation on the k selected values only (no dense mask)
+    Weights are frozen buffers. Scriptable with TorchScript and compilable
+    with torch.compile (see export_qsup / compile_qsup).
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.hidden_dim = model.hidden_dim
+        self.partial_norm = float(model.partial_norm)
+        self.self_modulation_steps = model.self_modulation_steps if model.gating_net is not None else 0
+        self.topk = model.topk if 0 < model.topk < model.hidden_dim else 0
+        with torch.no_grad():
+            self.register_buffer("wave_weight", torch.cat([net.weight for net in model.wavefunction_nets]).clone())
+            self.register_buffer("wave_bias", torch.cat([net.bias for net in model.wavefunction_nets]).clone())
+            self.register_buffer("cos_phase", torch.cos(model.phases).clone())  # [S, 1 or hidden_dim]
+            self.register_buffer("sin_phase", torch.sin(model.phases).clone())
+            gating = model.gating_net
+            self.register_buffer("gate_weight", gating.weight.clone() if self.self_modulation_steps else torch.zeros(0, 0))
+            self.register_buffer("gate_bias", gating.bias.clone() if self.self_modulation_steps else torch.zeros(0))
+            self.register_buffer("cls_weight", model.classifier.weight.clone())
+            self.register_buffer("cls_bias", model.classifier.bias.clone())
+
+    def forward(self, x):
+        H = self.hidden_dim
+        out = arc_bell_activation(F.linear(x, self.wave_weight, self.wave_bias))
+        out = out.view(x.shape[0], -1, 2, H)  # [batch, S, (alpha, beta), H]
+        alpha = out[:, :, 0]
+        beta = out[:, :, 1]
+        norm_sq = (alpha**2 + beta**2).sum(dim=2, keepdim=True) + 1e-8
+        factor = (self.partial_norm**2 / norm_sq).sqrt()
+        alpha = alpha * factor
+        beta = beta * factor
+        sup_real = (alpha * self.cos_phase - beta * self.sin_phase).sum(dim=1)
+        sup_imag = (alpha * self.sin_phase + beta * self.cos_phase).sum(dim=1)
+
+        for _ in range(self.self_modulation_steps):
+            mag = (sup_real**2 + sup_imag**2).sqrt()
+            gate = torch.sigmoid(F.linear(mag, self.gate_weight, self.gate_bias))
+            sup_real = sup_real * gate
+            sup_imag = sup_imag * gate
+
+        mag_sq = sup_real**2 + sup_imag**2
+        if self.topk > 0:
+            values, indices = torch.topk(mag_sq, k=self.topk, dim=1)
+            probs = torch.zeros_like(mag_sq).scatter(1, indices, values / (values.sum(dim=1, keepdim=True) + 1e-8))
+        else:
+            probs = mag_sq / (mag_sq.sum(dim=1, keepdim=True) + 1e-8)
+        return F.linear(probs, self.cls_weight, self.cls_bias)
+
+def export_qsup(model, path=None):
+    """TorchScript module of the fused (CPU) inference form; saved to `path` if given (load with torch.jit.load)."""
+    scripted = torch.jit.script(QSupFusedNet(model).cpu().eval())
+    if path:
+        scripted.save(path)
+    return scripted
+
+def compile_qsup(model, **compile_kwargs):
+    """torch.compile'd fused inference form (compiled on the first call)."""
+    return torch.compile(QSupFusedNet(model).eval(), **compile_kwargs)
+
+class QSupEnsemble(nn.Module):
+    """
+    K independent QSupFullNet models as one module with a leading model
+    dimension: forward maps x [K, batch, input_dim] to [K, batch, num_classes]
+    with batched matmuls. Members may differ in num_wavefunctions (padded with
+    masked-out wavefunctions, which get zero gradients), partial_norm and topk;
+    they share input/hidden/class sizes, phase_per_dim and self_modulation_steps.
+    """
+    def __init__(self, models):
+        super().__init__()
+        first = models[0]
+        for m in models:
+            if (m.input_dim, m.hidden_dim, m.num_classes, m.phase_per_dim, m.self_modulation_steps) != \
+                    (first.input_dim, first.hidden_dim, first.num_classes, first.phase_per_dim,
+                     first.self_modulation_steps):
+                raise ValueError("QSupEnsemble members must share sizes, phase_per_dim and self_modulation_steps")
+        self.hidden_dim = first.hidden_dim
+        self.self_modulation_steps = first.self_modulation_steps
+        self.num_wavefunctions = [m.num_wavefunctions for m in models]
+        self.max_wavefunctions = max(self.num_wavefunctions)
+        H, S = self.hidden_dim, self.max_wavefunctions
+
+        def padded(tensors):
+            # [n_s, ...] per model -> [K, S, ...], zeros past each model's n_s
+            out = torch.zeros(len(tensors), S, *tensors[0].shape[1:])
+            for k, t in enumerate(tensors):
+                out[k, :len(t)] = t.detach().cpu()
+            return out
+
+        # wave_weight[k, s*2H:(s+1)*2H] is wavefunction s's nn.Linear weight
+        self.wave_weight = nn.Parameter(padded([torch.stack([net.weight for net in m.wavefunction_nets])
+                                                for m in models]).flatten(1, 2))
+        self.wave_bias = nn.Parameter(padded([torch.stack([net.bias for net in m.wavefunction_nets])
+                                              for m in models]).flatten(1, 2))
+        self.phases = nn.Parameter(padded([m.phases for m in models]))
+        if self.self_modulation_steps > 0:
+            self.gate_weight = nn.Parameter(torch.stack([m.gating_net.weight.detach().cpu() for m in models]))
+            self.gate_bias = nn.Parameter(torch.stack([m.gating_net.bias.detach().cpu() for m in models]))
+        self.cls_weight = nn.Parameter(torch.stack([m.classifier.weight.detach().cpu() for m in models]))
+        self.cls_bias = nn.Parameter(torch.stack([m.classifier.bias.detach().cpu() for m in models]))
+
+        wave_mask = torch.zeros(len(models), S)
+        for k, n_s in enumerate(self.num_wavefunctions):
+            wave_mask[k, :n_s] = 1.0
+        self.register_buffer("wave_mask", wave_mask)
+        self.register_buffer("partial_norm", torch.tensor([float(m.partial_norm) for m in models]))
+        # topk <= 0 or >= hidden_dim keeps every unit, i.e. k = hidden_dim
+        self.register_buffer("topk", torch.tensor([m.topk if 0 < m.topk < H else H for m in models]))
+        self._templates = [dict(input_dim=m.input_dim, hidden_dim=H, num_classes=m.num_classes,
+                                num_wavefunctions=m.num_wavefunctions, partial_norm=m.partial_norm,
+                                phase_per_dim=m.phase_per_dim, self_modulation_steps=m.self_modulation_steps,
+                                topk=m.topk, device=m.device) for m in models]
+
+    def forward(self, x):
+        K, N, H, S = x.shape[0], x.shape[1], self.hidden_dim, self.max_wavefunctions
+        # 1) all wavefunctions of all models in one batched GEMM
+        out = torch.baddbmm(self.wave_bias.unsqueeze(1), x, self.wave_weight.transpose(1, 2))
+        out = arc_bell_activation(out).view(K, N, S, 2, H)
+        alpha, beta = out[:, :, :, 0], out[:, :, :, 1]
+        norm_sq = (alpha**2 + beta**2).sum(dim=-1, keepdim=True) + 1e-8
+        factor = (self.partial_norm.view(K, 1, 1, 1)**2 / norm_sq).sqrt()
+        alpha = alpha * factor
+        beta = beta * factor
+        cos = torch.cos(self.phases).unsqueeze(1)  # [K, 1, S, 1 or H]
+        sin = torch.sin(self.phases).unsqueeze(1)
+        mask = self.wave_mask.view(K, 1, S, 1)
+        sup_real = ((alpha * cos - beta * sin) * mask).sum(dim=2)
+        sup_imag = ((alpha * sin + beta * cos) * mask).sum(dim=2)
+
+        # 2) gating
+        for _ in range(self.self_modulation_steps):
+            mag = (sup_real**2 + sup_imag**2).sqrt()
+            gate = torch.sigmoid(torch.baddbmm(self.gate_bias.unsqueeze(1), mag, self.gate_weight.transpose(1, 2)))
+            sup_real = sup_real * gate
+            sup_imag = sup_imag * gate
+
+        # 3) top-k per model: keep units at or above each row's k-th largest value
+        mag_sq = sup_real**2 + sup_imag**2
+        kth = mag_sq.sort(dim=-1, descending=True).values.gather(
+            -1, (self.topk - 1).view(K, 1, 1).expand(K, N, 1))
+        masked = mag_sq * (mag_sq >= kth).to(mag_sq.dtype)
+        probs = masked / (masked.sum(dim=-1, keepdim=True) + 1e-8)
+
+        # 4) classification
+        return torch.baddbmm(self.cls_bias.unsqueeze(1), probs, self.cls_weight.transpose(1, 2))
+
+    def to_models(self):
+        """The trained members as separate QSupFullNet models."""
+        models = []
+        H = self.hidden_dim
+        for k, kwargs in enumerate(self._templates):
+            n_s = kwargs["num_wavefunctions"]
+            model = QSupFullNet(**kwargs)
+            weight = self.wave_weight[k].detach().cpu().view(-1, 2 * H, kwargs["input_dim"])
+            bias = self.wave_bias[k].detach().cpu().view(-1, 2 * H)
+            with torch.no_grad():
+                for s in range(n_s):
+                    model.wavefunction_nets[s].weight.copy_(weight[s])
+                    model.wavefunction_nets[s].bias.copy_(bias[s])
+                model.phases.copy_(self.phases[k, :n_s])
+                if self.self_modulation_steps > 0:
+                    model.gating_net.weight.copy_(self.gate_weight[k])
+                    model.gating_net.bias.copy_(self.gate_bias[k])
+                model.classifier.weight.copy_(self.cls_weight[k])
+                model.classifier.bias.copy_(self.cls_bias[k])
+            models.append(model.to(kwargs["device"]))
+        return models
+
+def _stack_padded(arrays, dtype):
+    """Stack arrays with different row counts into [K, max_rows, ...] plus a [K, max_rows] row mask."""
+    n_max = max(len(a) for a in arrays)
+    out = torch.zeros((len(arrays), n_max) + np.shape(arrays[0])[1:], dtype=dtype)
+    rows = torch.zeros(len(arrays), n_max)
+    for k, a in enumerate(arrays):
+        out[k, :len(a)] = torch.as_tensor(np.asarray(a), dtype=dtype)
+        rows[k, :len(a)] = 1.0
+    return out, rows
+
+def _masked_cross_entropy(logits, y, rows):
+    """Per-model mean cross-entropy over the real (unpadded) rows: [K]."""
+    K, N, C = logits.shape
+    ce = F.cross_entropy(logits.reshape(K * N, C), y.reshape(-1), reduction="none").view(K, N)
+    return (ce * rows).sum(dim=1) / rows.sum(dim=1)
+
+def train_qsup_ensemble(
+    datasets, configs,
+    input_dim, hidden_dim, num_classes,
+    phase_per_dim=False,
+    self_modulation_steps=0,
+    epochs=50,
+    log_dir=None,
+    device="cpu"
+):
+    """
+    Train one QSupFullNet per (dataset, config) pair as a single batched
+    computation (QSupEnsemble), full-batch like train_qsup_full_tb.
+    datasets: list of (X_train, y_train, X_val, y_val), e.g. CV folds;
+    configs: list of dicts of num_wavefunctions / partial_norm / topk.
+    Model k = i * len(configs) + j trains config j on dataset i. Summed
+    per-model losses give each member exactly its own gradients, and Adam is
+    elementwise, so every member trains as if alone.
+    Returns (models, train_loss_histories [K, epochs], val_loss_histories [K, epochs]).
+    """
+    pairs = [(data, config) for data in datasets for config in configs]
+    members = [QSupFullNet(input_dim=input_dim, hidden_dim=hidden_dim, num_classes=num_classes,
+                           phase_per_dim=phase_per_dim, self_modulation_steps=self_modulation_steps,
+                           device=device, **config) for _, config in pairs]
+    ensemble = QSupEnsemble(members).to(device)
+
+    X_train_t, train_rows = _stack_padded([d[0] for d, _ in pairs], torch.float)
+    y_train_t, _ = _stack_padded([d[1] for d, _ in pairs], torch.long)
+    X_val_t, val_rows = _stack_padded([d[2] for d, _ in pairs], torch.float)
+    y_val_t, _ = _stack_padded([d[3] for d, _ in pairs], torch.long)
+    X_train_t, train_rows, y_train_t, X_val_t, val_rows, y_val_t = (
+        t.to(device) for t in (X_train_t, train_rows, y_train_t, X_val_t, val_rows, y_val_t))
+
+    optimizer = torch.optim.Adam(ensemble.parameters(), lr=1e-3)
+    train_loss_history = torch.zeros(len(pairs), epochs)
+    val_loss_history = torch.zeros(len(pairs), epochs)
+
+    for epoch in range(epochs):
+        ensemble.train()
+        optimizer.zero_grad()
+        losses = _masked_cross_entropy(ensemble(X_train_t), y_train_t, train_rows)
+        losses.sum().backward()
+        optimizer.step()
+        with torch.no_grad():
+            val_losses = _masked_cross_entropy(ensemble(X_val_t), y_val_t, val_rows)
+        train_loss_history[:, epoch] = losses.detach().cpu()
+        val_loss_history[:, epoch] = val_losses.cpu()
+
+    if log_dir:
+        for k in range(len(pairs)):
+            writer = SummaryWriter(log_dir=os.path.join(log_dir, f"model_{k}"))
+            for epoch in range(epochs):
+                writer.add_scalar("QSupFull/Train_Loss", train_loss_history[k, epoch].item(), epoch + 1)
+                writer.add_scalar("QSupFull/Val_Loss", val_loss_history[k, epoch].item(), epoch + 1)
+            writer.close()
+    return ensemble.to_models(), train_loss_history.numpy(), val_loss_history.numpy()
+
 #############################################
 # 7) CROSS-VALIDATION FOR MLP & QSupFull
 #############################################
@@ -486,56 +854,61 @@ def cv_classification_MLP(CCV, y):
     print(classification_report(all_y_true, all_y_pred, target_names=['Control','Alzheimer']))
     print(f"Overall MLP Accuracy: {overall_acc:.4f}")
 
+def qsup_folds(CCV, y):
+    """The 3 stratified CV folds as (test_idx, X_train_res, y_train_res, X_test_scaled, y_test), SMOTE + scaling applied."""
+    skf = StratifiedKFold(n_splits=3, shuffle=True, random_state=5)
+    folds = []
+    for train_idx, test_idx in skf.split(CCV, y):
+        X_train, X_test = CCV[train_idx], CCV[test_idx]
+        y_train, y_test = y[train_idx], y[test_idx]
+
+        smote = SMOTE(random_state=5)
+        X_train_res, y_train_res = smote.fit_resample(X_train, y_train)
+
+        scaler = StandardScaler()
+        X_train_res = scaler.fit_transform(X_train_res)
+        X_test_scaled = scaler.transform(X_test)
+        folds.append((test_idx, X_train_res, y_train_res, X_test_scaled, y_test))
+    return folds
+
 def cv_classification_QSup(CCV, y):
     """
     3-fold CV with QSupFullNet (no in-place ops). 
     We set e.g. topk=0, self_mod_steps=0 as a default, 
     but you can tweak as you see fit.
+    The fold models are trained together as one ensemble (train_qsup_ensemble).
     """
-    skf = StratifiedKFold(n_splits=3, shuffle=True, random_state=5)
     all_y_true = []
     all_y_pred = []
-    fold_idx = 1
 
     device = "cuda" if torch.cuda.is_available() else "cpu"
     input_dim = CCV.shape[1]
     n_classes = len(np.unique(y))
 
-    for train_idx, test_idx in skf.split(CCV, y):
-        X_train, X_test = CCV[train_idx], CCV[test_idx]
-        y_train, y_test = y[train_idx], y[test_idx]
-
-        smote = SMOTE(random_state=5)
-        X_train_res, y_train_res = smote.fit_resample(X_train, y_train)
-
-        scaler = StandardScaler()
-        X_train_res = scaler.fit_transform(X_train_res)
-        X_test_scaled = scaler.transform(X_test)
-
-        log_dir = os.path.join(LOG_DIR, f"qsup_fold_{fold_idx}")
-        # Tweak these hyperparams
-        qsup_model, train_loss_hist, val_loss_hist = train_qsup_full_tb(
-            X_train_res, y_train_res,
-            X_test_scaled, y_test,
-            input_dim=input_dim,
-            hidden_dim=32,
-            num_classes=n_classes,
-            num_wavefunctions=3,
-            partial_norm=1.5,
-            phase_per_dim=False,
-            self_modulation_steps=2,
-            topk=8,
-            epochs=150,
-            log_dir=log_dir,
-            device=device
-        )
+    folds = qsup_folds(CCV, y)
+    # Tweak these hyperparams
+    models, train_loss_hists, val_loss_hists = train_qsup_ensemble(
+        [fold[1:] for fold in folds],
+        [dict(num_wavefunctions=3, partial_norm=1.5, topk=8)],
+        input_dim=input_dim,
+        hidden_dim=32,
+        num_classes=n_classes,
+        phase_per_dim=False,
+        self_modulation_steps=2,
+        epochs=150,
+        log_dir=os.path.join(LOG_DIR, "qsup_folds"),
+        device=device
+    )
 
-        # Evaluate
+    for fold_idx, ((_, _, _, X_test_scaled, y_test), qsup_model, train_loss_hist, val_loss_hist) in enumerate(
+            zip(folds, models, train_loss_hists, val_loss_hists), start=1):
+        # Evaluate with the fused inference form, and keep its TorchScript export
         X_test_t = torch.tensor(X_test_scaled, dtype=torch.float, device=device)
         qsup_model.eval()
         with torch.no_grad():
-            logits = qsup_model(X_test_t)
+            logits = QSupFusedNet(qsup_model)(X_test_t)
             preds = logits.argmax(dim=1).cpu().numpy()
+        export_qsup(qsup_model, os.path.join(MODELS_DIR, f"qsup_fold_{fold_idx}.pt"))
 
         all_y_true.extend(y_test)
         all_y_pred.extend(preds)
@@ -571,7 +944,6 @@ def cv_classification_QSup(CCV, y):
         plt.close()
 
         print(f"[Fold {fold_idx}] QSup Accuracy: {accuracy_score(y_test, preds):.4f}")
-        fold_idx += 1
 
     overall_acc = accuracy_score(all_y_true, all_y_pred)
     print("\n--- QSup Overall Classification ---")
@@ -579,6 +951,36 @@ def cv_classification_QSup(CCV, y):
     print(classification_report(all_y_true, all_y_pred, target_names=['Control','Alzheimer']))
     print(f"Overall QSup Accuracy: {overall_acc:.4f}")
 
+def grid_search_QSup(CCV, y, grid, epochs=150):
+    """
+    Every combination of `grid` on every CV fold, trained as one ensemble.
+    Prints and returns, per config, the mean fold accuracy and final val loss.
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    folds = qsup_folds(CCV, y)
+    keys = sorted(grid)
+    configs = [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+    models, _, val_loss_hists = train_qsup_ensemble(
+        [fold[1:] for fold in folds], configs,
+        input_dim=CCV.shape[1], hidden_dim=32, num_classes=len(np.unique(y)),
+        phase_per_dim=False, self_modulation_steps=2, epochs=epochs, device=device
+    )
+    accuracies = np.zeros((len(folds), len(configs)))
+    for i, (_, _, _, X_test_scaled, y_test) in enumerate(folds):
+        X_test_t = torch.tensor(X_test_scaled, dtype=torch.float, device=device)
+        for j in range(len(configs)):
+            model = models[i * len(configs) + j].eval()
+            with torch.no_grad():
+                accuracies[i, j] = accuracy_score(y_test, model(X_test_t).argmax(dim=1).cpu().numpy())
+    final_val = val_loss_hists[:, -1].reshape(len(folds), len(configs))
+    results = [dict(config, accuracy=accuracies[:, j].mean(), val_loss=final_val[:, j].mean())
+               for j, config in enumerate(configs)]
+    results.sort(key=lambda r: (-r["accuracy"], r["val_loss"]))
+    print(f"\n--- QSup grid: {len(configs)} configs x {len(folds)} folds ---")
+    for r in results:
+        print("  " + ", ".join(f"{k}={r[k]}" for k in keys) + f": acc {r['accuracy']:.4f}, val loss {r['val_loss']:.4f}")
+    return results
+
 #############################################
 # 8) MAIN (Combines GCN + MLP & QSupFull with no in-place ops)
 #############################################
@@ -590,7 +992,10 @@ def main():
     print(f"[INFO] {len(X_gnn)} GNN feature matrices loaded")
 
     # 2) Build PyG dataset for GCN
-    pyg_dataset = create_pyg_dataset(X_gnn, y, ch_names_list)
+    conn_list = load_connectivity(subj_ids)
+    if EDGE_MEASURE != "distance":
+        print(f"[INFO] {sum(c is not None for c in conn_list)} subjects with {EDGE_MEASURE} edges")
+    pyg_dataset = create_pyg_dataset(X_gnn, y, ch_names_list, conn_list)
     if len(pyg_dataset) == 0:
         raise ValueError("No valid PyG dataset could be constructed!")
     indices = np.arange(len(pyg_dataset))
@@ -598,10 +1003,9 @@ def main():
         indices, test_size=0.15, random_state=5,
         stratify=np.array([d.y.item() for d in pyg_dataset])
     )
-    train_dataset = [pyg_dataset[i] for i in train_idx]
-    val_dataset   = [pyg_dataset[i] for i in val_idx]
-    train_loader = PyGDataLoader(train_dataset, batch_size=4, shuffle=True)
-    val_loader   = PyGDataLoader(val_dataset,   batch_size=4, shuffle=False)
+    dense = create_dense_dataset(pyg_dataset) if GCN_ENGINE in ("auto", "dense") else None
+    if GCN_ENGINE == "dense" and dense is None:
+        raise ValueError("GCN_ENGINE='dense' needs the same number of nodes in every graph")
 
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     in_channels = X_gnn[0].shape[1]
@@ -610,35 +1014,57 @@ def main():
     gcn_model = GCNNet(in_channels, hidden_channels, gcn_num_classes).to(device)
     optimizer = TorchAdam(gcn_model.parameters(), lr=pow(10,-2.25))
     epochs_gcn = 100
+    batch_size = 4
 
     # 3) Train GCN
-    print("[GCN] Training embeddings ...")
+    print(f"[GCN] Training embeddings ({'dense' if dense is not None else 'PyG'} engine) ...")
+    if dense is not None:
+        X_dense, A_dense, y_dense = (t.to(device) for t in dense)
+        train_idx_t = torch.as_tensor(train_idx, device=device)
+    else:
+        train_dataset = [pyg_dataset[i] for i in train_idx]
+        train_loader = PyGDataLoader(train_dataset, batch_size=batch_size, shuffle=True)
     for epoch in range(1, epochs_gcn+1):
         gcn_model.train()
         total_loss = 0
-        for data in train_loader:
-            data = data.to(device)
-            optimizer.zero_grad()
-            logits = gcn_model(data.x, data.edge_index, data.batch)
-            loss = F.cross_entropy(logits, data.y.view(-1))
-            loss.backward()
-            optimizer.step()
-            total_loss += loss.item() * data.num_graphs
-        avg_loss = total_loss / len(train_loader.dataset)
+        if dense is not None:
+            # Mini-batches are index slices of the stacked tensors: no collation
+            order = train_idx_t[torch.randperm(len(train_idx_t), device=device)]
+            for start in range(0, len(order), batch_size):
+                idx = order[start:start + batch_size]
+                optimizer.zero_grad()
+                logits = gcn_model.forward_dense(X_dense[idx], A_dense if A_dense.dim() == 2 else A_dense[idx])
+                loss = F.cross_entropy(logits, y_dense[idx])
+                loss.backward()
+                optimizer.step()
+                total_loss += loss.item() * len(idx)
+        else:
+            for data in train_loader:
+                data = data.to(device)
+                optimizer.zero_grad()
+                logits = gcn_model(data.x, data.edge_index, data.batch, data.edge_weight)
+                loss = F.cross_entropy(logits, data.y.view(-1))
+                loss.backward()
+                optimizer.step()
+                total_loss += loss.item() * data.num_graphs
+        avg_loss = total_loss / len(train_idx)
         if epoch % 5 == 0:
             print(f"GCN Epoch {epoch}/{epochs_gcn} - Train Loss: {avg_loss:.4f}")
 
     # 4) Extract embeddings
     print("[GCN] Extracting embeddings for entire dataset ...")
-    full_loader = PyGDataLoader(pyg_dataset, batch_size=4, shuffle=False)
     gcn_model.eval()
-    embeddings = []
     with torch.no_grad():
-        for data in full_loader:
-            data = data.to(device)
-            emb = gcn_model.embed(data.x, data.edge_index, data.batch)
-            embeddings.append(emb.cpu().numpy())
-    embeddings = np.vstack(embeddings)
+        if dense is not None:
+            embeddings = gcn_model.embed_dense(X_dense, A_dense).cpu().numpy()
+        else:
+            full_loader = PyGDataLoader(pyg_dataset, batch_size=batch_size, shuffle=False)
+            embeddings = []
+            for data in full_loader:
+                data = data.to(device)
+                emb = gcn_model.embed(data.x, data.edge_index, data.batch, data.edge_weight)
+                embeddings.append(emb.cpu().numpy())
+            embeddings = np.vstack(embeddings)
     print(f"[INFO] GCN embeddings shape: {embeddings.shape}")
 
     # 5) Combine => CCV
@@ -655,6 +1081,10 @@ def main():
     print("\n=== 3-Fold Classification with QSup ===")
     cv_classification_QSup(CCV, y)
 
+    # 8) QSup hyperparameter grid
+    if QSUP_GRID:
+        grid_search_QSup(CCV, y, QSUP_GRID)
+
     end_time = time.time()
     print(f"[DONE] total runtime: {end_time - start_time:.2f} seconds")
 
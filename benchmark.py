@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""
+Feature-Extraction Benchmark
+
+Times the feature kernels of process_server.py on synthetic EEG and appends the
+results to a JSON history, flagging regressions against the previous run on the
+same machine.
+
+Benchmarked, for every (channels, duration, sample rate) case:
+  • compute_hjorth_parameters_numba, compute_shannon_entropy (all epochs at once)
+  • extract_features_epoch, extract_channel_features_GNN_epoch (one epoch)
+  • process_subject_combined on the recording written as an EEGLAB .set file
+    (needs the optional eeglabio package; skipped if it is missing)
+
+Each benchmark reports its first call separately from the steady-state median,
+so Numba JIT compilation (paid by the first Numba case of the run) and cache
+warm-up are visible. Run with e.g.:
+  python benchmark.py --channels 19 64 --durations 60 600 --sfreqs 256 500
+"""
+
+#############################################
+# CONFIGURATION & IMPORTS
+#############################################
+import os, json, time, argparse, platform, subprocess, tempfile
+import numpy as np
+import mne
+import numba
+
+import process_server as ps
+
+HISTORY_PATH = os.path.join("benchmarks", "benchmark_history.json")
+REGRESSION_THRESHOLD = 0.15  # flag steady-state medians more than 15% slower than the last run
+DEFAULT_CHANNELS = [19, 64]
+DEFAULT_DURATIONS = [60.0, 300.0]  # seconds
+DEFAULT_SFREQS = [256.0, 500.0]  # Hz
+ALPHA_FREQ = 10.0  # Hz, dominant rhythm of the synthetic signal
+
+#############################################
+# 1) SYNTHETIC EEG
+#############################################
+def synthetic_eeg(n_channels, duration, sfreq, seed=0):
+    """1/f background plus a per-channel alpha rhythm, ~20 µV, as (n_channels, n_times) in volts."""
+    rng = np.random.default_rng(seed)
+    n_times = int(round(duration * sfreq))
+    freqs = np.fft.rfftfreq(n_times, 1.0 / sfreq)
+    spectrum = rng.standard_normal((n_channels, len(freqs))) + 1j * rng.standard_normal((n_channels, len(freqs)))
+    spectrum /= np.sqrt(np.maximum(freqs, freqs[1]))
+    data = np.fft.irfft(spectrum, n=n_times, axis=-1)
+    t = np.arange(n_times) / sfreq
+    phases = rng.uniform(0, 2 * np.pi, (n_channels, 1))
+    data += 0.5 * np.std(data) * np.sin(2 * np.pi * ALPHA_FREQ * t + phases)
+    return data / np.std(data) * 20e-6
+
+def synthetic_raw(n_channels, duration, sfreq, seed=0):
+    """RawArray with channels spread over the standard 10-05 montage (positions are needed for CSD)."""
+    montage = mne.channels.make_standard_montage("standard_1005")
+    picks = np.linspace(0, len(montage.ch_names) - 1, n_channels).astype(int)
+    ch_names = [montage.ch_names[i] for i in picks]
+    info = mne.create_info(ch_names, sfreq, "eeg")
+    raw = mne.io.RawArray(synthetic_eeg(n_channels, duration, sfreq, seed), info, verbose=False)
+    raw.set_montage(montage, verbose=False)
+    return raw
+
+def write_eeglab(raw, path):
+    """Export raw as an EEGLAB .set file; returns False when eeglabio is not installed."""
+    try:
+        mne.export.export_raw(path, raw, fmt="eeglab", overwrite=True, verbose=False)
+    except ImportError:
+        return False
+    return True
+
+#############################################
+# 2) TIMING
+#############################################
+def time_call(fn, repeats):
+    """First-call time and steady-state statistics over `repeats` further calls."""
+    t0 = time.perf_counter()
+    fn()
+    first = time.perf_counter() - t0
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    median = float(np.median(times))
+    return {
+        "first_s": first,
+        "median_s": median,
+        "min_s": float(np.min(times)),
+        "warmup_overhead_s": max(first - median, 0.0),
+        "repeats": repeats,
+    }
+
+def case_key(name, n_channels, duration, sfreq):
+    return f"{name}|ch={n_channels}|dur={duration:g}s|sfreq={sfreq:g}Hz"
+
+def benchmark_case(n_channels, duration, sfreq, repeats, full_repeats, workdir):
+    """All benchmarks for one synthetic recording -> {case_key: timing}."""
+    raw = synthetic_raw(n_channels, duration, sfreq)
+    epochs = mne.make_fixed_length_epochs(raw, duration=ps.EPOCH_DURATION, overlap=ps.EPOCH_OVERLAP, verbose=False)
+    data = epochs.get_data()
+    if len(data) == 0:
+        raise ValueError(f"Duration {duration}s is shorter than one {ps.EPOCH_DURATION}s epoch.")
+    epoch = data[0]
+
+    # Numba kernels first, so the first case of the run shows JIT compilation in first_s
+    benchmarks = {
+        "compute_hjorth_parameters_numba": (lambda: ps.compute_hjorth_parameters_numba(data), repeats),
+        "compute_shannon_entropy": (lambda: ps.compute_shannon_entropy(data), repeats),
+        "extract_features_epoch": (lambda: ps.extract_features_epoch(epoch), repeats),
+        "extract_channel_features_GNN_epoch": (lambda: ps.extract_channel_features_GNN_epoch(epoch, sfreq), repeats),
+    }
+    set_path = os.path.join(workdir, f"bench_{n_channels}ch_{duration:g}s_{sfreq:g}Hz.set")
+    # Every full-path call must decode, filter and resample, and nothing may land in the
+    # real processed_features/ tree: no preprocessed cache, CSD operators cached in workdir
+    ps.PREPROCESS_CACHE = False
+    ps.CSD_CACHE_DIR = os.path.join(workdir, "csd_cache")
+    if full_repeats > 0:
+        if write_eeglab(raw, set_path):
+            benchmarks["process_subject_combined"] = (lambda: ps.process_subject_combined((set_path, 0)), full_repeats)
+        else:
+            print("[WARNING] eeglabio not installed; skipping process_subject_combined.")
+
+    results = {}
+    for name, (fn, n) in benchmarks.items():
+        timing = time_call(fn, n)
+        results[case_key(name, n_channels, duration, sfreq)] = timing
+        print(f"[INFO] {case_key(name, n_channels, duration, sfreq):<70} "
+              f"first {timing['first_s'] * 1e3:9.2f} ms   median {timing['median_s'] * 1e3:9.2f} ms")
+    return results
+
+#############################################
+# 3) HISTORY & REGRESSION CHECK
+#############################################
+def environment():
+    """What the timings depend on; runs are only compared within the same environment."""
+    return {
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "numba_threads": numba.get_num_threads(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "numba": numba.__version__,
+        "mne": mne.__version__,
+    }
+
+def git_revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as fp:
+        return json.load(fp)
+
+def find_regressions(history, run, threshold):
+    """
+    Cases whose steady-state median is more than `threshold` slower than in the
+    last run with the same environment and extraction parameters.
+    """
+    regressions = []
+    for key, timing in run["results"].items():
+        for previous in reversed(history):
+            if (previous["environment"] != run["environment"] or previous["params"] != run["params"]
+                    or key not in previous["results"]):
+                continue
+            baseline = previous["results"][key]["median_s"]
+            if timing["median_s"] > baseline * (1.0 + threshold):
+                regressions.append((key, baseline, timing["median_s"]))
+            break
+    return regressions
+
+#############################################
+# 4) MAIN
+#############################################
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark EEG feature extraction on synthetic data.")
+    parser.add_argument("--channels", type=int, nargs="+", default=DEFAULT_CHANNELS)
+    parser.add_argument("--durations", type=float, nargs="+", default=DEFAULT_DURATIONS, help="seconds")
+    parser.add_argument("--sfreqs", type=float, nargs="+", default=DEFAULT_SFREQS, help="Hz")
+    parser.add_argument("--repeats", type=int, default=20, help="steady-state calls per kernel")
+    parser.add_argument("--full-repeats", type=int, default=3,
+                        help="steady-state calls of process_subject_combined (0 to skip)")
+    parser.add_argument("--threads", type=int, default=None, help="Numba thread count")
+    parser.add_argument("--history", default=HISTORY_PATH)
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument("--label", default="", help="free-text note stored with the run")
+    parser.add_argument("--no-save", action="store_true", help="do not append this run to the history")
+    args = parser.parse_args()
+
+    if args.threads:
+        numba.set_num_threads(args.threads)
+    mne.set_log_level("ERROR")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for n_channels in args.channels:
+            for duration in args.durations:
+                for sfreq in args.sfreqs:
+                    results.update(benchmark_case(n_channels, duration, sfreq,
+                                                  args.repeats, args.full_repeats, workdir))
+
+    run = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": git_revision(),
+        "label": args.label,
+        "environment": environment(),
+        "params": ps.extraction_params(),
+        "results": results,
+    }
+    history = load_history(args.history)
+    regressions = find_regressions(history, run, args.threshold)
+    if not args.no_save:
+        os.makedirs(os.path.dirname(args.history) or ".", exist_ok=True)
+        with open(args.history, "w") as fp:
+            json.dump(history + [run], fp, indent=1)
+        print(f"[INFO] Appended run to {args.history}")
+
+    for key, baseline, median in regressions:
+        print(f"[REGRESSION] {key}: {baseline * 1e3:.2f} ms -> {median * 1e3:.2f} ms "
+              f"(+{(median / baseline - 1) * 100:.0f}%)")
+    if regressions:
+        raise SystemExit(1)
+    print("[DONE] No regressions beyond the threshold.")
+
+if __name__ == "__main__":
+    main()
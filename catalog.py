@@ -0,0 +1,206 @@
+"""
+BIDS Dataset Catalog
+
+SQLite index of the EEG datasets, built by one scan of each dataset's
+participants.tsv, its EEGLAB recordings and their *_eeg.json / *_channels.tsv
+sidecars. The pipelines query the catalog instead of globbing the trees and
+re-parsing the TSVs on every start-up.
+
+Tables:
+  datasets      name, signature of the definition and tree it was scanned from
+  participants  dataset, subject, Group, class label, all participants.tsv columns (JSON)
+  recordings    path, dataset, subject, size, mtime, sampling rate, channel count,
+                duration, channel names (JSON)
+
+A dataset is rescanned when its definition in DATASETS changes or when the
+mtime of its participants.tsv, root or recordings directory changes (adding a
+subject folder changes the directory mtime). Edits deeper in the tree are not
+noticed: rebuild explicitly (Catalog(rebuild=True), or process_server.py
+--rebuild-catalog) after replacing recordings in place.
+"""
+
+import os
+import json
+import glob
+import sqlite3
+
+import pandas as pd
+
+# Directory holding ds004504/ and ds003800/ (default: next to this file)
+DATA_ROOT = os.environ.get("SF_DATA_ROOT", os.path.dirname(os.path.abspath(__file__)))
+CATALOG_PATH = os.path.join("processed_features", "catalog.sqlite")
+CATALOG_VERSION = 1
+
+# recordings: directory scanned (recursively) for `pattern`, relative to root.
+# group_labels: participants.tsv Group -> class label; "*" matches any group,
+# participants of other groups stay unlabelled.
+DATASETS = [
+    {"name": "ds004504", "root": os.path.join(DATA_ROOT, "ds004504"), "recordings": "derivatives",
+     "pattern": "*.set", "group_labels": {"A": 1, "C": 0}},  # F (frontotemporal dementia) left out
+    {"name": "ds003800", "root": os.path.join(DATA_ROOT, "ds003800"), "recordings": "",
+     "pattern": "*_task-Rest_eeg.set", "group_labels": {"*": 1}},
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS datasets (
+    name TEXT PRIMARY KEY, signature TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS participants (
+    dataset TEXT NOT NULL, subject TEXT NOT NULL, grp TEXT, label INTEGER, attributes TEXT,
+    PRIMARY KEY (dataset, subject));
+CREATE TABLE IF NOT EXISTS recordings (
+    path TEXT PRIMARY KEY, dataset TEXT NOT NULL, subject TEXT NOT NULL, size INTEGER, mtime_ns INTEGER,
+    sfreq REAL, n_channels INTEGER, duration REAL, ch_names TEXT);
+CREATE INDEX IF NOT EXISTS recordings_subject ON recordings (dataset, subject);
+"""
+
+#############################################
+# 1) SIDECARS
+#############################################
+def sidecar_path(set_path, suffix):
+    """
+    The BIDS sidecar `<prefix>_<suffix>` of a recording, or None. Derivatives
+    have no sidecars of their own; the raw dataset's apply.
+    """
+    prefix = os.path.basename(set_path).rsplit("_eeg", 1)[0]
+    folder = os.path.dirname(set_path)
+    candidates = [os.path.join(folder, f"{prefix}_{suffix}")]
+    parts = folder.split(os.sep)
+    if "derivatives" in parts:
+        i = parts.index("derivatives")
+        rest = parts[i + 1:]
+        if rest and not rest[0].startswith("sub-"):  # derivatives/<pipeline>/sub-...
+            rest = rest[1:]
+        candidates.append(os.path.join(os.sep.join(parts[:i] + rest), f"{prefix}_{suffix}"))
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    return None
+
+def recording_metadata(set_path):
+    """Sampling rate, channel count/names and duration from the recording's sidecars (None where absent)."""
+    meta = {"sfreq": None, "n_channels": None, "duration": None, "ch_names": None}
+    json_path = sidecar_path(set_path, "eeg.json")
+    if json_path is not None:
+        with open(json_path, "r") as fp:
+            sidecar = json.load(fp)
+        n_channels = sum(sidecar.get(k, 0) or 0 for k in
+                         ["EEGChannelCount", "EOGChannelCount", "ECGChannelCount", "EMGChannelCount"])
+        meta.update(sfreq=sidecar.get("SamplingFrequency"), n_channels=n_channels or None,
+                    duration=sidecar.get("RecordingDuration"))
+    channels_path = sidecar_path(set_path, "channels.tsv")
+    if channels_path is not None:
+        names = pd.read_csv(channels_path, sep="\t", dtype=str, keep_default_na=False)["name"].tolist()
+        meta.update(n_channels=len(names), ch_names=names)
+    return meta
+
+#############################################
+# 2) CATALOG
+#############################################
+def _mtime_ns(path):
+    return os.stat(path).st_mtime_ns if os.path.exists(path) else None
+
+def dataset_signature(dataset):
+    """What a dataset's catalog entries were scanned from; any change triggers a rescan."""
+    root = dataset["root"]
+    return json.dumps({
+        "version": CATALOG_VERSION,
+        "dataset": dataset,
+        "mtimes": [_mtime_ns(p) for p in (os.path.join(root, "participants.tsv"), root,
+                                          os.path.join(root, dataset["recordings"]))],
+    }, sort_keys=True)
+
+class Catalog:
+    def __init__(self, path=CATALOG_PATH, datasets=DATASETS, rebuild=False):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.datasets = datasets
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+        for dataset in datasets:
+            self.refresh(dataset, force=rebuild)
+
+    def refresh(self, dataset, force=False):
+        """Rescan one dataset if it changed since the last scan (or if forced)."""
+        signature = dataset_signature(dataset)
+        row = self.conn.execute("SELECT signature FROM datasets WHERE name = ?", (dataset["name"],)).fetchone()
+        if not force and row is not None and row["signature"] == signature:
+            return
+        participants, recordings = self._scan(dataset)
+        with self.conn:
+            self.conn.execute("DELETE FROM participants WHERE dataset = ?", (dataset["name"],))
+            self.conn.execute("DELETE FROM recordings WHERE dataset = ?", (dataset["name"],))
+            self.conn.executemany("INSERT INTO participants VALUES (?, ?, ?, ?, ?)", participants)
+            self.conn.executemany("INSERT INTO recordings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", recordings)
+            self.conn.execute("INSERT OR REPLACE INTO datasets VALUES (?, ?)", (dataset["name"], signature))
+        print(f"[INFO] Catalogued {dataset['name']}: {len(participants)} participants, "
+              f"{len(recordings)} recordings.")
+
+    @staticmethod
+    def _scan(dataset):
+        name, root = dataset["name"], dataset["root"]
+        participants_file = os.path.join(root, "participants.tsv")
+        if not os.path.exists(participants_file):
+            print(f"[WARNING] {participants_file} not found; dataset {name} is empty in the catalog.")
+            return [], []
+        group_labels = dataset["group_labels"]
+        participants = []
+        table = pd.read_csv(participants_file, sep="\t", dtype=str, keep_default_na=False)
+        for attributes in table.to_dict("records"):
+            group = attributes.get("Group")
+            label = group_labels.get(group, group_labels.get("*"))
+            participants.append((name, attributes["participant_id"], group, label, json.dumps(attributes)))
+
+        recordings = []
+        pattern = os.path.join(root, dataset["recordings"], "**", dataset["pattern"])
+        for path in sorted(glob.glob(pattern, recursive=True)):
+            # Unfetched (e.g. git-annex) files are catalogued without size
+            st = os.stat(path) if os.path.exists(path) else None
+            meta = recording_metadata(path)
+            recordings.append((
+                path, name, os.path.basename(path).split("_")[0],
+                st.st_size if st else None, st.st_mtime_ns if st else None,
+                meta["sfreq"], meta["n_channels"], meta["duration"],
+                json.dumps(meta["ch_names"]) if meta["ch_names"] is not None else None,
+            ))
+        return participants, recordings
+
+    def participant_labels(self):
+        """{subject: label} of all labelled participants (later datasets win on clashes)."""
+        labels = {}
+        for dataset in self.datasets:
+            rows = self.conn.execute("SELECT subject, label FROM participants WHERE dataset = ? AND label IS NOT NULL",
+                                     (dataset["name"],))
+            labels.update({row["subject"]: row["label"] for row in rows})
+        return labels
+
+    def recordings(self, labelled=True, where="", params=()):
+        """
+        Recording records (dicts with the participant's group and label), in
+        dataset order then path order. `labelled` drops recordings without a
+        labelled participant; `where` adds an SQL condition on the columns of
+        recordings r / participants p, e.g. where="r.duration < ?", params=(600,).
+        """
+        order = " ".join(f"WHEN ? THEN {i}" for i in range(len(self.datasets)))
+        conditions = ["p.label IS NOT NULL"] if labelled else []
+        if where:
+            conditions.append(f"({where})")
+        query = (f"SELECT r.*, p.grp AS grp, p.label AS label FROM recordings r "
+                 f"LEFT JOIN participants p ON p.dataset = r.dataset AND p.subject = r.subject "
+                 f"{'WHERE ' + ' AND '.join(conditions) if conditions else ''} "
+                 f"ORDER BY CASE r.dataset {order} ELSE {len(self.datasets)} END, r.path")
+        rows = self.conn.execute(query, tuple(params) + tuple(d["name"] for d in self.datasets))
+        return [self._record(row) for row in rows]
+
+    def recording(self, path):
+        """Record of one recording by path, or None if it is not catalogued."""
+        row = self.conn.execute("SELECT r.*, p.grp AS grp, p.label AS label FROM recordings r "
+                                "LEFT JOIN participants p ON p.dataset = r.dataset AND p.subject = r.subject "
+                                "WHERE r.path = ?", (path,)).fetchone()
+        return self._record(row) if row is not None else None
+
+    @staticmethod
+    def _record(row):
+        record = dict(row)
+        record["group"] = record.pop("grp")
+        record["ch_names"] = json.loads(record["ch_names"]) if record["ch_names"] is not None else None
+        return record
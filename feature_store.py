@@ -0,0 +1,395 @@
+"""
+Feature Store
+
+On-disk bookkeeping for processed_features/.
+
+  • The extraction manifest (processed_features/manifest.json) records, for
+    each subject, a content hash of its input files, a fingerprint of the
+    preprocessing parameters, and the output paths written for it.
+    process_server.main() uses it to skip subjects whose inputs and parameters
+    are unchanged and to resume an interrupted run.
+  • The epoch store (processed_features/epochs/) keeps per-epoch feature
+    matrices: one flat float32 file per feature family plus an index of
+    subject -> row ranges, readable as lazy memory maps.
+  • The feature bundle (processed_features/features.bundle) packs every
+    labelled subject's summary features into one file, so training opens
+    one memory map instead of three files per subject.
+"""
+
+import os
+import json
+import hashlib
+import mmap
+import shutil
+import struct
+import time
+
+import numpy as np
+
+MANIFEST_VERSION = 1
+EPOCH_STORE_VERSION = 1
+BUNDLE_VERSION = 1
+
+#############################################
+# 1) INPUT HASHING
+#############################################
+def file_sha256(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def input_files_for(set_path):
+    """The .set file plus its .fdt data file when the recording is split in two."""
+    files = [set_path]
+    fdt_path = os.path.splitext(set_path)[0] + ".fdt"
+    if os.path.exists(fdt_path):
+        files.append(fdt_path)
+    return files
+
+def describe_inputs(set_path, previous=None, root=None):
+    """
+    Size, mtime and sha256 for each input file of a recording, keyed by its
+    path relative to root (when given), so a manifest stays valid when the
+    dataset sits elsewhere on another machine (merged shards).
+
+    Hashes from a previous manifest entry are reused when size and mtime are
+    unchanged, so an unchanged cohort is not re-read on every run.
+    """
+    known = (previous or {}).get("inputs", {})
+    inputs = {}
+    for path in input_files_for(set_path):
+        key = input_key(path, root)
+        st = os.stat(path)
+        old = known.get(key)
+        if old and old["size"] == st.st_size and old["mtime_ns"] == st.st_mtime_ns:
+            digest = old["sha256"]
+        else:
+            digest = file_sha256(path)
+        inputs[key] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": digest}
+    return inputs
+
+def input_key(path, root=None):
+    """Manifest key of an input file: relative to root when it lies below it, else absolute."""
+    path = os.path.abspath(path)
+    if root is not None:
+        rel = os.path.relpath(path, os.path.abspath(root))
+        if rel != os.pardir and not rel.startswith(os.pardir + os.sep):
+            return rel
+    return path
+
+def relocate_inputs(manifest, root):
+    """Re-key absolute input paths below root (manifests written before describe_inputs took a root)."""
+    for entry in manifest["subjects"].values():
+        if any(os.path.isabs(p) for p in entry.get("inputs", {})):
+            entry["inputs"] = {input_key(p, root): info for p, info in entry["inputs"].items()}
+
+def params_fingerprint(params):
+    blob = json.dumps(params, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(blob).hexdigest()
+
+#############################################
+# 2) ATOMIC WRITES
+#############################################
+# Write to a temporary file next to the target, then rename over it: readers
+# (and reruns after a crash) see either the old file or the complete new one.
+# The temporary name is per process, so workers racing on one target are safe.
+def atomic_save_npy(path, arr):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as fp:
+        np.save(fp, arr)
+    os.replace(tmp_path, path)
+
+def atomic_save_npz(path, **arrays):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as fp:
+        np.savez(fp, **arrays)
+    os.replace(tmp_path, path)
+
+def atomic_save_json(path, obj, **json_kwargs):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump(obj, fp, **json_kwargs)
+    os.replace(tmp_path, path)
+
+def atomic_copy(src, dst):
+    tmp_path = f"{dst}.{os.getpid()}.tmp"
+    shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+#############################################
+# 3) MANIFEST READ / WRITE
+#############################################
+def empty_manifest():
+    return {"version": MANIFEST_VERSION, "params": {}, "subjects": {}}
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return empty_manifest()
+    try:
+        with open(path, "r") as fp:
+            manifest = json.load(fp)
+    except (OSError, ValueError) as e:
+        print(f"[WARNING] Ignoring unreadable manifest {path}: {e}")
+        return empty_manifest()
+    if manifest.get("version") != MANIFEST_VERSION:
+        print(f"[WARNING] Manifest {path} has version {manifest.get('version')}, rebuilding.")
+        return empty_manifest()
+    return manifest
+
+def save_manifest(manifest, path):
+    """Atomic write, so a crash mid-save never leaves a truncated manifest."""
+    atomic_save_json(path, manifest, indent=1, sort_keys=True)
+
+#############################################
+# 4) SUBJECT ENTRIES
+#############################################
+def is_up_to_date(entry, inputs, params_hash):
+    if not entry or entry.get("params_hash") != params_hash:
+        return False
+    old_inputs = entry.get("inputs", {})
+    if set(old_inputs) != set(inputs):
+        return False
+    if any(old_inputs[p]["sha256"] != inputs[p]["sha256"] for p in inputs):
+        return False
+    return all(os.path.exists(p) for p in entry.get("outputs", {}).values())
+
+def record_subject(manifest, subj_id, inputs, params_hash, outputs, label, screening=None):
+    manifest["subjects"][subj_id] = {
+        "inputs": inputs,
+        "params_hash": params_hash,
+        "outputs": outputs,
+        "label": label,
+        "screening": screening,
+        "completed": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+#############################################
+# 5) PER-EPOCH FEATURE STORE
+#############################################
+def _load_epoch_index(root):
+    index_path = os.path.join(root, "index.json")
+    if not os.path.exists(index_path):
+        return {"version": EPOCH_STORE_VERSION, "families": {}, "subjects": {}}
+    with open(index_path, "r") as fp:
+        index = json.load(fp)
+    if index.get("version") != EPOCH_STORE_VERSION:
+        raise ValueError(f"Unsupported epoch store version in {index_path}: {index.get('version')}")
+    return index
+
+class EpochStoreWriter:
+    """
+    Append-only writer for the per-epoch store.
+
+    Each family is a flat row-major float32 file of shape (n_rows, width),
+    where width is the last axis of the arrays appended to it; a subject's
+    array is written as reshape(-1, width) and its original shape is kept in
+    the index. Rewriting a subject appends fresh rows and repoints the index;
+    the index is the source of truth, so bytes past the indexed row count
+    (left by a crash mid-append) are truncated on open, and compact() drops
+    rows no subject points to any more.
+
+    The store holds features of one extraction configuration: opened with a
+    different params_hash than it was written with, it starts over empty.
+    """
+    def __init__(self, root, params_hash=None):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.index = _load_epoch_index(root)
+        for name, fam in self.index["families"].items():
+            fam.setdefault("file", f"{name}.f32")
+        if params_hash is not None and self.index.get("params_hash") != params_hash:
+            if self.index["subjects"]:
+                print(f"[WARNING] Epoch store {root} was written with other extraction parameters; starting it over.")
+            old_files = [self._path(fam) for fam in self.index["families"].values()]
+            self.index = {"version": EPOCH_STORE_VERSION, "families": {}, "subjects": {}, "params_hash": params_hash}
+            self._save_index()
+            for path in old_files:
+                if os.path.exists(path):
+                    os.remove(path)
+        for fam in self.index["families"].values():
+            path = self._path(fam)
+            expected = fam["rows"] * fam["width"] * 4
+            if os.path.exists(path) and os.path.getsize(path) > expected:
+                with open(path, "r+b") as fp:
+                    fp.truncate(expected)
+
+    def _path(self, fam):
+        return os.path.join(self.root, fam["file"])
+
+    def _save_index(self):
+        save_manifest(self.index, os.path.join(self.root, "index.json"))
+
+    def __contains__(self, subj_id):
+        return subj_id in self.index["subjects"]
+
+    def append(self, subj_id, families):
+        """families: dict of name -> array whose last axis is the row width."""
+        entry = {}
+        for name, arr in families.items():
+            arr = np.ascontiguousarray(arr, dtype=np.float32)
+            width = arr.shape[-1]
+            fam = self.index["families"].setdefault(name, {"width": width, "rows": 0, "file": f"{name}.f32"})
+            if fam["width"] != width:
+                raise ValueError(f"Family '{name}' has width {fam['width']}, got {width}")
+            rows = arr.reshape(-1, width)
+            with open(self._path(fam), "ab") as fp:
+                fp.write(rows.tobytes())
+                fp.flush()
+                os.fsync(fp.fileno())
+            entry[name] = {"start": fam["rows"], "stop": fam["rows"] + rows.shape[0],
+                           "shape": list(arr.shape)}
+            fam["rows"] += rows.shape[0]
+        self.index["subjects"][subj_id] = entry
+        self._save_index()
+
+    def compact(self, min_dead_fraction=0.25):
+        """
+        Rewrite each family whose unreferenced rows exceed min_dead_fraction of
+        the file. Live rows go to a new file, the index is switched to it, and
+        only then is the old file removed, so a crash leaves a readable store.
+        """
+        for name, fam in self.index["families"].items():
+            entries = [(subj_id, e[name]) for subj_id, e in self.index["subjects"].items() if name in e]
+            live = sum(e["stop"] - e["start"] for _, e in entries)
+            if fam["rows"] - live <= min_dead_fraction * fam["rows"]:
+                continue
+            old_path = self._path(fam)
+            old = np.memmap(old_path, dtype=np.float32, mode="r", shape=(fam["rows"], fam["width"]))
+            new_file = f"{name}.{int(time.time() * 1000)}.f32"
+            with open(os.path.join(self.root, new_file), "wb") as fp:
+                start = 0
+                for _, e in sorted(entries, key=lambda item: item[1]["start"]):
+                    n_rows = e["stop"] - e["start"]
+                    fp.write(np.ascontiguousarray(old[e["start"]:e["stop"]]).tobytes())
+                    e["start"], e["stop"] = start, start + n_rows
+                    start += n_rows
+                fp.flush()
+                os.fsync(fp.fileno())
+            del old
+            print(f"[INFO] Compacted epoch family '{name}': {fam['rows']} -> {live} rows.")
+            fam["rows"], fam["file"] = live, new_file
+            self._save_index()
+            os.remove(old_path)
+
+class EpochStore:
+    """
+    Read-only lazy view of the per-epoch store. Files are memory-mapped on first
+    use, so slicing a subject touches only that subject's rows.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.index = _load_epoch_index(root)
+        self._maps = {}
+
+    def __contains__(self, subj_id):
+        return subj_id in self.index["subjects"]
+
+    def subjects(self):
+        return list(self.index["subjects"].keys())
+
+    def family(self, name):
+        """All rows of one family as an (n_rows, width) read-only memmap."""
+        if name not in self._maps:
+            fam = self.index["families"][name]
+            self._maps[name] = np.memmap(os.path.join(self.root, fam.get("file", f"{name}.f32")), dtype=np.float32,
+                                         mode="r", shape=(fam["rows"], fam["width"]))
+        return self._maps[name]
+
+    def epochs(self, subj_id, name):
+        """One subject's array for a family in its original shape (a memmap view)."""
+        entry = self.index["subjects"][subj_id][name]
+        return self.family(name)[entry["start"]:entry["stop"]].reshape(entry["shape"])
+
+#############################################
+# 6) FEATURE BUNDLE
+#############################################
+# Layout: BUNDLE_MAGIC, the header length (uint64 LE), a JSON header, then the
+# arrays, each starting on a BUNDLE_ALIGN boundary:
+#   handcrafted  float32 (n_subjects, n_features)
+#   gnn          float32 (total channels, n_bands): subjects' (n_channels, n_bands) blocks back to back
+#   gnn_offsets  int64   (n_subjects + 1,) row range of each subject in gnn
+#   labels       int32   (n_subjects,)
+# The header holds the subject IDs, the distinct channel lists and each
+# subject's index into them, and the dtype/shape/offset of every array.
+BUNDLE_MAGIC = b"SFBUNDLE"
+BUNDLE_ALIGN = 64
+
+def write_feature_bundle(path, subj_ids, handcrafted, gnn, ch_names, labels, params_hash=None,
+                         psd_method=None):
+    """
+    Atomically write the bundle; gnn and ch_names are per-subject lists (channel
+    counts may differ), params_hash the fingerprint of the extraction parameters
+    and psd_method the PSD backend the band powers were computed with.
+    """
+    channel_sets, channel_set = {}, []
+    for names in ch_names:
+        channel_set.append(channel_sets.setdefault(tuple(names), len(channel_sets)))
+    gnn_offsets = np.cumsum([0] + [len(g) for g in gnn]).astype(np.int64)
+    arrays = {
+        "handcrafted": np.ascontiguousarray(handcrafted, dtype=np.float32),
+        "gnn": np.ascontiguousarray(np.concatenate(gnn, axis=0), dtype=np.float32),
+        "gnn_offsets": gnn_offsets,
+        "labels": np.asarray(labels, dtype=np.int32),
+    }
+    layout, offset = {}, 0
+    for name, arr in arrays.items():
+        layout[name] = {"dtype": arr.dtype.str, "shape": list(arr.shape), "offset": offset}
+        offset += -(-arr.nbytes // BUNDLE_ALIGN) * BUNDLE_ALIGN
+    header = json.dumps({
+        "version": BUNDLE_VERSION,
+        "params_hash": params_hash,
+        "psd_method": psd_method,
+        "subjects": list(subj_ids),
+        "channel_sets": [list(names) for names in channel_sets],
+        "channel_set": channel_set,
+        "arrays": layout,
+    }).encode("utf-8")
+    prefix = len(BUNDLE_MAGIC) + 8
+    data_start = -(-(prefix + len(header)) // BUNDLE_ALIGN) * BUNDLE_ALIGN
+    header += b" " * (data_start - prefix - len(header))
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as fp:
+        fp.write(BUNDLE_MAGIC + struct.pack("<Q", len(header)) + header)
+        for name, arr in arrays.items():
+            fp.seek(data_start + layout[name]["offset"])
+            fp.write(arr.tobytes())
+        fp.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+def load_feature_bundle(path):
+    """
+    Memory-map a bundle: {"params_hash", "psd_method", "subjects", "handcrafted" (n_subjects, n_features),
+    "gnn" (list of (n_channels, n_bands)), "ch_names" (list of lists), "labels"}.
+    Arrays are read-only views of one map; pages are read when used.
+    """
+    with open(path, "rb") as fp:
+        buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    prefix = len(BUNDLE_MAGIC) + 8
+    if buf[:len(BUNDLE_MAGIC)] != BUNDLE_MAGIC:
+        raise ValueError(f"{path} is not a feature bundle")
+    (header_len,) = struct.unpack("<Q", buf[len(BUNDLE_MAGIC):prefix])
+    header = json.loads(buf[prefix:prefix + header_len])
+    if header.get("version") != BUNDLE_VERSION:
+        raise ValueError(f"Unsupported feature bundle version in {path}: {header.get('version')}")
+    data_start = prefix + header_len
+
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        count = int(np.prod(spec["shape"]))
+        arrays[name] = np.frombuffer(buf, dtype=dtype, count=count,
+                                     offset=data_start + spec["offset"]).reshape(spec["shape"])
+    offsets = arrays["gnn_offsets"]
+    channel_sets = header["channel_sets"]
+    return {
+        "params_hash": header.get("params_hash"),
+        "psd_method": header.get("psd_method") or "multitaper",  # the only backend before PSD_METHOD
+        "subjects": header["subjects"],
+        "handcrafted": arrays["handcrafted"],
+        "gnn": [arrays["gnn"][offsets[i]:offsets[i + 1]] for i in range(len(header["subjects"]))],
+        "ch_names": [channel_sets[i] for i in header["channel_set"]],
+        "labels": arrays["labels"],
+    }
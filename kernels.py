@@ -0,0 +1,336 @@
+"""
+Signal Kernels
+
+Fused Numba kernel for the time-domain EEG features (Shannon entropy and Hjorth
+parameters), shared by process_server.py and server.py.
+
+One parallel (prange) sweep over an (n_epochs, n_channels, n_times) array
+collects, per channel, the mean, variance, first/second-difference moments,
+peak-to-peak amplitude and the 256-bin histogram entropy over time, plus, per
+epoch, the across-channel histogram entropy averaged over time. Every entropy/Hjorth definition used in
+this project is derived from these statistics instead of separate numpy passes,
+and the same statistics drive process_server's artifact screening.
+
+For overlapping windows of one continuous signal, window_signal_stats walks
+the signal once instead of once per window: moments come from prefix sums and
+the per-sample across-channel entropy is averaged per window, so the cost
+barely depends on the overlap. It leaves out the per-channel histogram
+entropy, which needs each window's own value range.
+
+The kernel is compiled eagerly for explicit float64 and float32 signatures and
+cached on disk (numba cache=True, in __pycache__ or NUMBA_CACHE_DIR), so only
+the first process after a code change compiles; later processes load machine
+code. warm_up() loads both specialisations and starts the threading layer, for
+worker initialisers and server start-up.
+"""
+
+import numpy as np
+from numba import njit, prange, void, int64, float32, float64
+from numba.types import Array
+
+N_BINS = 256
+
+# Columns of the per-channel statistics array returned by signal_stats
+STAT_MEAN, STAT_VAR, STAT_D1_MEAN, STAT_D1_MS, STAT_D2_MEAN, STAT_D2_MS, STAT_ENTROPY, STAT_PTP = range(8)
+N_STATS = 8
+
+# (data, n_bins, stats, time_entropy), C-contiguous arrays as signal_stats passes them
+KERNEL_SIGNATURES = [
+    void(dtype[:, :, ::1], int64, float64[:, :, ::1], float64[::1]) for dtype in (float64, float32)
+]
+# (signal, starts, window_len, block, n_bins, stats, time_entropy); the signal
+# may also be a read-only memmap (process_server's preprocessed cache)
+WINDOW_KERNEL_SIGNATURES = [
+    void(Array(dtype, 2, "C", readonly=readonly), int64[::1], int64, int64, int64, float64[:, :, ::1], float64[::1])
+    for dtype in (float64, float32) for readonly in (False, True)
+]
+
+#############################################
+# 1) NUMBA KERNELS
+#############################################
+@njit(cache=True)
+def _hist_range(lo, hi):
+    # np.histogram widens an empty range by 0.5 on each side
+    if lo == hi:
+        return lo - 0.5, hi + 0.5
+    return lo, hi
+
+@njit(cache=True)
+def _hist_bin(x, lo, hi, n_bins):
+    """Bin index of x, reproducing np.histogram's uniform-bin edge handling."""
+    step = (hi - lo) / n_bins
+    idx = int(((x - lo) / (hi - lo)) * n_bins)
+    if idx == n_bins:
+        idx -= 1
+    # edges are np.linspace(lo, hi, n_bins + 1): k * step + lo, last edge == hi
+    if x < idx * step + lo:
+        idx -= 1
+    elif idx != n_bins - 1:
+        upper = hi if idx + 1 == n_bins else (idx + 1) * step + lo
+        if x >= upper:
+            idx += 1
+    return idx
+
+@njit(cache=True)
+def _sample_entropy(x, k, n_bins, counts, bins):
+    """Histogram entropy across the channels of x[:, k]; counts must be all zero and is left so."""
+    n_channels = x.shape[0]
+    lo = x[0, k]
+    hi = lo
+    for j in range(1, n_channels):
+        v = x[j, k]
+        if v < lo:
+            lo = v
+        if v > hi:
+            hi = v
+    lo, hi = _hist_range(lo, hi)
+    for j in range(n_channels):
+        b = _hist_bin(x[j, k], lo, hi, n_bins)
+        bins[j] = b
+        counts[b] += 1
+    h = 0.0
+    for j in range(n_channels):
+        b = bins[j]
+        if counts[b] > 0:
+            p = counts[b] / n_channels
+            h -= p * np.log2(p + 1e-12)
+            counts[b] = 0  # count each occupied bin once, and reset for the next sample
+    return h
+
+@njit(cache=True)
+def _diff1(x, k):
+    return x[k] - x[k - 1] if k >= 1 else 0.0
+
+@njit(cache=True)
+def _diff2(x, k):
+    return _diff1(x, k) - _diff1(x, k - 1) if k >= 2 else 0.0
+
+@njit(KERNEL_SIGNATURES, parallel=True, cache=True)
+def _signal_stats_kernel(data, n_bins, stats, time_entropy):
+    n_epochs, n_channels, n_times = data.shape
+
+    # Per-channel statistics: one moments sweep + one histogram sweep per row
+    for r in prange(n_epochs * n_channels):
+        i = r // n_channels
+        j = r % n_channels
+        x0 = data[i, j, 0]
+        s = 0.0
+        s2 = 0.0
+        d1s = 0.0
+        d1ss = 0.0
+        d2s = 0.0
+        d2ss = 0.0
+        lo = x0
+        hi = x0
+        prev = x0
+        prev_d = 0.0
+        for k in range(n_times):
+            x = data[i, j, k]
+            v = x - x0  # shifted sums keep the one-pass variance accurate
+            s += v
+            s2 += v * v
+            if x < lo:
+                lo = x
+            if x > hi:
+                hi = x
+            if k >= 1:
+                d = x - prev
+                d1s += d
+                d1ss += d * d
+                if k >= 2:
+                    dd = d - prev_d
+                    d2s += dd
+                    d2ss += dd * dd
+                prev_d = d
+            prev = x
+        stats[i, j, 0] = x0 + s / n_times
+        stats[i, j, 1] = (s2 - s * s / n_times) / n_times
+        stats[i, j, 2] = d1s / (n_times - 1)
+        stats[i, j, 3] = d1ss / (n_times - 1)
+        stats[i, j, 4] = d2s / (n_times - 2)
+        stats[i, j, 5] = d2ss / (n_times - 2)
+        stats[i, j, 7] = hi - lo
+
+        lo, hi = _hist_range(lo, hi)
+        counts = np.zeros(n_bins, dtype=np.int64)
+        for k in range(n_times):
+            counts[_hist_bin(data[i, j, k], lo, hi, n_bins)] += 1
+        h = 0.0
+        for b in range(n_bins):
+            if counts[b] > 0:
+                p = counts[b] / n_times
+                h -= p * np.log2(p + 1e-12)
+        stats[i, j, 6] = h
+
+    # Across-channel histogram entropy at each time sample, averaged over time
+    for i in prange(n_epochs):
+        counts = np.zeros(n_bins, dtype=np.int64)
+        bins = np.empty(n_channels, dtype=np.int64)
+        acc = 0.0
+        for k in range(n_times):
+            acc += _sample_entropy(data[i], k, n_bins, counts, bins)
+        time_entropy[i] = acc / n_times
+
+@njit(WINDOW_KERNEL_SIGNATURES, parallel=True, cache=True)
+def _window_stats_kernel(signal, starts, window_len, block, n_bins, stats, time_entropy):
+    # Window bounds fall on multiples of `block`, so running sums are only kept
+    # at block boundaries; the few terms a window's first samples exclude
+    # (their differences reach back before the window) are recomputed directly.
+    n_channels, n_samples = signal.shape
+    n_blocks = n_samples // block
+    L = window_len
+
+    for j in prange(n_channels):
+        x = signal[j]
+        x0 = x[0]  # shift keeps the sums of squares accurate
+        p1 = np.zeros(n_blocks + 1)
+        p2 = np.zeros(n_blocks + 1)
+        q = np.zeros(n_blocks + 1)  # squared first differences
+        r = np.zeros(n_blocks + 1)  # squared second differences
+        bmin = np.empty(n_blocks)
+        bmax = np.empty(n_blocks)
+        for bi in range(n_blocks):
+            s1 = 0.0
+            s2 = 0.0
+            s3 = 0.0
+            s4 = 0.0
+            lo = x[bi * block]
+            hi = lo
+            for k in range(bi * block, (bi + 1) * block):
+                v = x[k] - x0
+                s1 += v
+                s2 += v * v
+                d = _diff1(x, k)
+                s3 += d * d
+                dd = _diff2(x, k)
+                s4 += dd * dd
+                if x[k] < lo:
+                    lo = x[k]
+                if x[k] > hi:
+                    hi = x[k]
+            p1[bi + 1] = p1[bi] + s1
+            p2[bi + 1] = p2[bi] + s2
+            q[bi + 1] = q[bi] + s3
+            r[bi + 1] = r[bi] + s4
+            bmin[bi] = lo
+            bmax[bi] = hi
+        for w in range(len(starts)):
+            s = starts[w]
+            e = s + L
+            a = s // block
+            z = e // block
+            S = p1[z] - p1[a]
+            stats[w, j, 0] = x0 + S / L
+            stats[w, j, 1] = (p2[z] - p2[a] - S * S / L) / L
+            stats[w, j, 2] = (x[e - 1] - x[s]) / (L - 1)
+            stats[w, j, 3] = (q[z] - q[a] - _diff1(x, s) ** 2) / (L - 1)
+            stats[w, j, 4] = (_diff1(x, e - 1) - _diff1(x, s + 1)) / (L - 2)
+            stats[w, j, 5] = (r[z] - r[a] - _diff2(x, s) ** 2 - _diff2(x, s + 1) ** 2) / (L - 2)
+            stats[w, j, 6] = np.nan
+            lo = bmin[a]
+            hi = bmax[a]
+            for bi in range(a + 1, z):
+                if bmin[bi] < lo:
+                    lo = bmin[bi]
+                if bmax[bi] > hi:
+                    hi = bmax[bi]
+            stats[w, j, 7] = hi - lo
+
+    # Across-channel entropy per sample, summed per block, averaged per window
+    h_blocks = np.empty(n_blocks)
+    for bi in prange(n_blocks):
+        counts = np.zeros(n_bins, dtype=np.int64)
+        bins = np.empty(n_channels, dtype=np.int64)
+        acc = 0.0
+        for k in range(bi * block, (bi + 1) * block):
+            acc += _sample_entropy(signal, k, n_bins, counts, bins)
+        h_blocks[bi] = acc
+    h_prefix = np.zeros(n_blocks + 1)
+    for bi in range(n_blocks):
+        h_prefix[bi + 1] = h_prefix[bi] + h_blocks[bi]
+    for w in range(len(starts)):
+        time_entropy[w] = (h_prefix[(starts[w] + L) // block] - h_prefix[starts[w] // block]) / L
+
+#############################################
+# 2) PUBLIC API
+#############################################
+def signal_stats(data, n_bins=N_BINS):
+    """
+    Fused statistics for data of shape (n_epochs, n_channels, n_times).
+    float32 input is read as float32 (half the memory traffic); moments and
+    entropies are always accumulated in float64.
+
+    Returns:
+      stats        (n_epochs, n_channels, N_STATS), columns STAT_*
+      time_entropy (n_epochs,) across-channel histogram entropy, averaged over time
+    """
+    data = np.ascontiguousarray(data, dtype=np.float32 if data.dtype == np.float32 else np.float64)
+    n_epochs, n_channels, _ = data.shape
+    stats = np.empty((n_epochs, n_channels, N_STATS), dtype=np.float64)
+    time_entropy = np.empty(n_epochs, dtype=np.float64)
+    _signal_stats_kernel(data, n_bins, stats, time_entropy)
+    return stats, time_entropy
+
+def window_signal_stats(signal, starts, window_len, n_bins=N_BINS):
+    """
+    signal_stats of the windows signal[:, s:s + window_len], s in starts, read
+    from the continuous (n_channels, n_samples) signal without cutting them.
+    Equal to signal_stats on the cut windows up to rounding, except that
+    STAT_ENTROPY is NaN. Cheapest when window_len and the starts share a large
+    common divisor (e.g. a hop that divides the window length).
+    """
+    signal = np.ascontiguousarray(signal, dtype=np.float32 if signal.dtype == np.float32 else np.float64)
+    starts = np.ascontiguousarray(starts, dtype=np.int64)
+    if window_len < 3:
+        raise ValueError("Windows need at least 3 samples for second differences.")
+    if len(starts) and (starts.min() < 0 or starts.max() + window_len > signal.shape[1]):
+        raise ValueError("Windows must lie inside the signal.")
+    block = int(np.gcd.reduce(np.append(starts, window_len)))
+    stats = np.empty((len(starts), signal.shape[0], N_STATS), dtype=np.float64)
+    time_entropy = np.empty(len(starts), dtype=np.float64)
+    _window_stats_kernel(signal, starts, window_len, block, n_bins, stats, time_entropy)
+    return stats, time_entropy
+
+def warm_up():
+    """Load (or compile into the cache) all kernel specialisations and start Numba's threads."""
+    for dtype in (np.float64, np.float32):
+        signal_stats(np.zeros((1, 2, 16), dtype=dtype))
+        window_signal_stats(np.zeros((2, 16), dtype=dtype), np.array([0, 4]), 8)
+
+def hjorth_from_stats(stats, n_times):
+    """
+    Per-channel Hjorth activity, mobility and complexity, with the definitions
+    (and 1e-12 floors) of process_server.compute_hjorth_parameters_numba.
+    """
+    activity = np.maximum(stats[..., STAT_VAR], 1e-12)
+    mobility = np.sqrt(stats[..., STAT_D1_MS] / activity)
+    d2_sum = np.maximum(stats[..., STAT_D2_MS] * (n_times - 2), 1e-12)
+    complexity = np.sqrt(d2_sum / (n_times - 2)) / (mobility + 1e-12)
+    return activity, mobility, complexity
+
+def fused_signal_features(data):
+    """Entropy and Hjorth features for data of shape (n_epochs, n_channels, n_times); see features_from_stats."""
+    stats, time_entropy = signal_stats(data)
+    return features_from_stats(stats, time_entropy, data.shape[-1])
+
+def features_from_stats(stats, time_entropy, n_times):
+    """
+    Entropy and Hjorth features from signal_stats output, for epochs of n_times samples.
+
+    Per-channel values: "channel_entropy" (histogram entropy over time),
+    "activity", "mobility", "complexity", each (n_epochs, n_channels).
+    Per-epoch averages used as handcrafted features: "shannon_entropy"
+    (across-channel entropy averaged over time), "hjorth_activity",
+    "hjorth_mobility", "hjorth_complexity", each (n_epochs,).
+    """
+    activity, mobility, complexity = hjorth_from_stats(stats, n_times)
+    return {
+        "channel_entropy": stats[..., STAT_ENTROPY],
+        "activity": activity,
+        "mobility": mobility,
+        "complexity": complexity,
+        "shannon_entropy": time_entropy,
+        "hjorth_activity": np.mean(activity, axis=1),
+        "hjorth_mobility": np.mean(mobility, axis=1),
+        "hjorth_complexity": np.mean(complexity, axis=1),
+    }
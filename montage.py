@@ -0,0 +1,127 @@
+"""
+Montage Operators
+
+Cached current-source-density (CSD) transform for the GNN branch, and the
+cached channel graphs the GCN in ai_model.py runs on.
+
+The spherical-spline CSD of mne.preprocessing.compute_current_source_density is
+a fixed linear map over channels that depends only on the channel set, their
+positions and digitization, and the spline parameters; it does not depend on the
+data. It is obtained once per montage by applying CSD to an identity signal,
+kept in memory per process and stored under an on-disk cache so every worker
+and every later run reuses it. Applying it is a single (n_channels, n_channels)
+matrix product, without copying a Raw or re-solving the G/H systems per subject.
+
+The distance graph likewise depends only on the channel list: it is built once
+per channel tuple (montage positions, distance threshold, GCN normalisation)
+and stored in the same way, so building a GCN dataset is a lookup per subject.
+"""
+
+import os
+import json
+import hashlib
+
+import numpy as np
+import mne
+from scipy.spatial.distance import pdist, squareform
+
+from feature_store import atomic_save_npy, atomic_save_npz
+
+# compute_current_source_density defaults, passed explicitly so they are part of the cache key
+CSD_PARAMS = {"lambda2": 1e-5, "stiffness": 4, "n_legendre_terms": 50}
+
+# Distance graph: channels closer than this percentile of the pairwise distances are connected
+GRAPH_PARAMS = {"montage": "standard_1020", "distance_percentile": 30}
+
+_csd_operators = {}
+_graphs = {}
+
+#############################################
+# 1) MONTAGE KEY
+#############################################
+def montage_key(info):
+    """Hash of everything the CSD operator depends on: channels, positions, digitization, params."""
+    h = hashlib.sha256()
+    h.update(json.dumps([info.ch_names, info.get_channel_types(), sorted(info["bads"]),
+                         CSD_PARAMS]).encode("utf-8"))
+    h.update(np.array([ch["loc"][:3] for ch in info["chs"]], dtype=np.float64).tobytes())
+    for d in info["dig"] or []:
+        h.update(np.int64(d["kind"]).tobytes())
+        h.update(np.asarray(d["r"], dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+#############################################
+# 2) CSD OPERATOR
+#############################################
+def csd_operator(info, cache_dir=None):
+    """
+    (n_channels, n_channels) matrix M with CSD(x) == M @ x for data laid out
+    like info. Non-EEG channels pass through unchanged, as in MNE.
+    """
+    key = montage_key(info)
+    operator = _csd_operators.get(key)
+    if operator is not None:
+        return operator
+    path = os.path.join(cache_dir, f"csd_{key[:16]}.npy") if cache_dir else None
+    if path and os.path.exists(path):
+        operator = np.load(path)
+    else:
+        probe = mne.io.RawArray(np.eye(len(info.ch_names)), info.copy(), verbose=False)
+        operator = mne.preprocessing.compute_current_source_density(probe, **CSD_PARAMS).get_data()
+        if path:
+            os.makedirs(cache_dir, exist_ok=True)
+            atomic_save_npy(path, operator)
+    _csd_operators[key] = operator
+    return operator
+
+def apply_csd(data, operator):
+    """CSD over the channel axis of (..., n_channels, n_times) data, in the data's precision."""
+    return np.matmul(operator.astype(data.dtype, copy=False), data)
+
+#############################################
+# 3) CHANNEL GRAPHS
+#############################################
+def gcn_normalize(A):
+    """
+    Edge list of D^-1/2 (A + I) D^-1/2 for a symmetric weighted adjacency A
+    (zero diagonal): the normalisation GCNConv applies, self-loops included.
+    Returns (edge_index (2, n_edges) int64, edge_weight (n_edges,) float32).
+    """
+    A = A + np.eye(len(A), dtype=A.dtype)
+    inv_sqrt_deg = 1.0 / np.sqrt(A.sum(axis=0))
+    A_hat = inv_sqrt_deg[:, None] * A * inv_sqrt_deg[None, :]
+    edge_index = np.array(np.nonzero(A_hat), dtype=np.int64)
+    return edge_index, A_hat[edge_index[0], edge_index[1]].astype(np.float32)
+
+def graph_key(ch_names):
+    return hashlib.sha256(json.dumps([list(ch_names), GRAPH_PARAMS]).encode("utf-8")).hexdigest()
+
+def distance_graph(ch_names, cache_dir=None):
+    """
+    Distance-threshold graph of the channels with a position in the montage:
+    {"nodes": their indices into ch_names (the node order), "edge_index",
+    "edge_weight" (GCN-normalised)}, or None if no channel has a position.
+    """
+    key = graph_key(ch_names)
+    if key in _graphs:
+        return _graphs[key]
+    path = os.path.join(cache_dir, f"graph_{key[:16]}.npz") if cache_dir else None
+    if path and os.path.exists(path):
+        with np.load(path) as cached:
+            graph = {name: cached[name] for name in ["nodes", "edge_index", "edge_weight"]}
+    else:
+        pos_dict = mne.channels.make_standard_montage(GRAPH_PARAMS["montage"]).get_positions()["ch_pos"]
+        nodes = np.array([i for i, ch in enumerate(ch_names) if ch in pos_dict], dtype=np.int64)
+        graph = None
+        if len(nodes):
+            coords = np.array([pos_dict[ch_names[i]] for i in nodes])
+            D = squareform(pdist(coords))
+            A = (D < np.percentile(D, GRAPH_PARAMS["distance_percentile"])).astype(np.float32)
+            np.fill_diagonal(A, 0)
+            edge_index, edge_weight = gcn_normalize(A)
+            graph = {"nodes": nodes, "edge_index": edge_index, "edge_weight": edge_weight}
+            if path:
+                os.makedirs(cache_dir, exist_ok=True)
+                atomic_save_npz(path, **graph)
+    _graphs[key] = graph
+    return graph
@@ -2,28 +2,58 @@
 """
 EEG Processing Script
 
-This script loads EEG .set files from the specified directories, computes:
+This script loads the EEG .set files listed in the dataset catalog
+(catalog.py, processed_features/catalog.sqlite) and computes:
   1. Handcrafted global features (mean and standard deviation of per‐epoch handcrafted features)
   2. GNN aggregated features (channel-level band-power features, averaged over epochs)
   3. Channel names (from the montage after applying current source density)
+  4. Per-epoch handcrafted and GNN feature matrices (processed_features/epochs/)
+  5. Per-band channel-pair coherence and phase-locking value (next to the GNN features)
+  6. A bundle of 1-3 for all labelled subjects in one file (processed_features/features.bundle)
 
-It then saves each subject’s outputs in dedicated directories.
+It then saves each subject’s outputs in dedicated directories. A manifest
+(processed_features/manifest.json) records input hashes and preprocessing
+parameters, so a rerun only processes new or changed subjects. Filtered and
+resampled signals are cached under processed_features/preprocessed/, so a
+change to the feature definitions does not re-read the EEGLAB files.
 Parallel processing is used via ProcessPoolExecutor.
+
+Larger cohorts can be split across machines or batch jobs:
+  python process_server.py --shard 0/3     # on each box, i = 0, 1, 2
+  python process_server.py --merge         # after copying processed_features/shards/ together
 """
 
 #############################################
 # CONFIGURATION & IMPORTS
 #############################################
-import os, glob, json, warnings, time
+import os, glob, json, warnings, time, argparse, hashlib, multiprocessing
+from fractions import Fraction
 import numpy as np
-import pandas as pd
 import mne
 import networkx as nx
 from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
 from imblearn.over_sampling import SMOTE
-from numba import njit
+
+from spectral import (
+    compute_band_tensor, shares_segments, segment_band_powers, window_band_powers, ConnectivityAccumulator,
+    WELCH_N_FFT
+)
+from kernels import (
+    fused_signal_features, features_from_stats, signal_stats, window_signal_stats, warm_up as warm_up_kernels,
+    STAT_VAR, STAT_PTP
+)
+from montage import csd_operator, apply_csd
+from tracing import stage, start_trace, stop_trace, append_trace, print_run_summary
+from scheduler import default_memory_budget_mb, worker_plan, limit_threads, run_packed
+from signal_cache import PreprocessedCache
+from catalog import Catalog, DATA_ROOT
+from feature_store import (
+    load_manifest, save_manifest, describe_inputs, relocate_inputs, params_fingerprint,
+    is_up_to_date, record_subject, EpochStoreWriter, EpochStore, atomic_save_npy, atomic_save_json,
+    atomic_copy, write_feature_bundle
+)
 
 # Suppress warnings and logs
 mne.set_log_level('WARNING')
@@ -33,11 +63,52 @@ os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
 #############################################
 # CONFIGURATION (Update paths as needed)
 #############################################
-DS004504_PATH = "/Users/ishaangubbala/Documents/SF/ds004504/derivatives"
-DS003800_PATH = "/Users/ishaangubbala/Documents/SF/ds003800/"
-PARTICIPANTS_FILE_DS004504 = "/Users/ishaangubbala/Documents/SF/ds004504/participants.tsv"
-PARTICIPANTS_FILE_DS003800 = "/Users/ishaangubbala/Documents/SF/ds003800/participants.tsv"
+# Dataset locations and group labels are defined in catalog.DATASETS
+# (SF_DATA_ROOT selects the directory holding ds004504/ and ds003800/)
 SAMPLING_RATE = 256  # Hz
+FILTER_BAND = (1.0, 50.0)  # Hz, FIR band-pass applied before resampling
+EPOCH_DURATION = 20.0  # seconds
+# Overlapping epochs (hop = EPOCH_DURATION - EPOCH_OVERLAP) give more training
+# rows per subject. With PSD_METHOD "welch" and a hop that is a whole number of
+# Welch segments (1 s at 256 Hz), the preloaded path transforms each segment
+# once and the time-domain kernel always walks the signal once, so 50-90%
+# overlap costs close to none; multitaper PSDs are still one per epoch.
+EPOCH_OVERLAP = 0.0  # seconds
+EPOCH_BATCH = 64  # epochs per PSD batch when epochs are cut (multitaper, periodogram)
+
+# Per-band channel-pair coherence and phase-locking value on the CSD montage
+# (the GNN branch's input), from the kept epochs' 1 s Welch segments. Saved next
+# to *_gnn.npy as *_coherence.npy and *_plv.npy, (n_bands, n_channels, n_channels),
+# for subject-specific weighted graph edges in ai_model.py.
+CONNECTIVITY = True
+
+# Streaming mode: read/filter/resample the recording in chunks of whole epochs
+# instead of preloading it, so per-worker memory is set by the budget below
+# rather than by recording length.
+STREAMING = False
+STREAM_MEMORY_BUDGET_MB = 512
+STREAM_MARGIN = 5  # seconds of context around each chunk (filter + resampler transients)
+
+# PSD backend for all band powers: "multitaper" (reference), "welch" or
+# "periodogram" (see spectral.py). Recorded in the manifest, so changing it
+# re-extracts every subject.
+PSD_METHOD = "multitaper"
+
+# Opt-in single precision from epoching on: CSD, PSD and the entropy/Hjorth
+# kernels read and write float32 (the kernels still accumulate in float64).
+# MNE filtering/resampling stay float64. Check the feature drift against the
+# float64 baseline with --validate-float32 before switching a cohort over.
+FLOAT32 = False
+
+# Artifact screening: right after epoching, epochs are checked on the fused
+# kernel statistics and dropped before CSD and spectral analysis if any channel
+# is flat, exceeds the peak-to-peak limit (movement, clipping, electrode pops)
+# or has a variance far above the epoch's median channel. Per-subject rejection
+# counts are recorded in the manifest.
+SCREEN_EPOCHS = True
+FLAT_PTP = 1e-6  # V, peak-to-peak below which a channel counts as flat
+REJECT_PTP = 500e-6  # V
+REJECT_VAR_RATIO = 20.0  # channel variance over the epoch's median channel variance
 
 FREQUENCY_BANDS = {
     "Delta": (0.5, 4), "Theta1": (4, 6), "Theta2": (6, 8),
@@ -51,199 +122,848 @@ BASE_OUTPUT_DIR = "processed_features"
 HANDCRAFTED_DIR = os.path.join(BASE_OUTPUT_DIR, "handcrafted")
 GNN_DIR = os.path.join(BASE_OUTPUT_DIR, "gnn")
 CHANNELS_DIR = os.path.join(BASE_OUTPUT_DIR, "channels")
+CSD_CACHE_DIR = os.path.join(BASE_OUTPUT_DIR, "csd_cache")  # per-montage CSD operators
+# Index of participants, recordings and their sidecar metadata (see catalog.py)
+CATALOG_PATH = os.path.join(BASE_OUTPUT_DIR, "catalog.sqlite")
+# Per-subject stage timings (wall, CPU, peak RSS), one JSON line per subject
+TRACE = True
+# Filtered + resampled signals as float32 memmaps, keyed by preprocess_params(),
+# so feature changes do not re-decode and re-filter the EEGLAB files. The
+# features read the map in place only with FLOAT32; the float64 default
+# upcasts the whole recording into memory once.
+PREPROCESS_CACHE = True
+PREPROCESSED_DIR = os.path.join(BASE_OUTPUT_DIR, "preprocessed")
+# Shard-local output trees for --shard i/N, merged into the above with --merge
+SHARDS_DIR = os.path.join(BASE_OUTPUT_DIR, "shards")
+
+# Worker scheduling: tasks are packed under a RAM budget, largest first
+MAX_WORKERS = None  # None: one per CPU core (concurrency is still limited by the budget)
+MEMORY_BUDGET_MB = None  # None: 80% of the RAM available at start-up
+# Per-task peak memory model, calibrated on the preloaded path: the read/filter
+# working set scales with input samples, the resampled signal, its CSD copy and
+# the PSD temporaries with output samples (at SAMPLING_RATE).
+WORKER_BASE_MB = 350
+PRELOAD_BYTES_PER_INPUT_SAMPLE = 12
+PRELOAD_BYTES_PER_OUTPUT_SAMPLE = 92
 for d in [BASE_OUTPUT_DIR, HANDCRAFTED_DIR, GNN_DIR, CHANNELS_DIR]:
     os.makedirs(d, exist_ok=True)
 
+def output_layout(base_dir):
+    """Output paths under one processed_features tree (the main one or a shard's)."""
+    layout = {
+        "base": base_dir,
+        "handcrafted": os.path.join(base_dir, "handcrafted"),
+        "gnn": os.path.join(base_dir, "gnn"),
+        "channels": os.path.join(base_dir, "channels"),
+        "epochs": os.path.join(base_dir, "epochs"),  # per-epoch feature store
+        "manifest": os.path.join(base_dir, "manifest.json"),
+        "bundle": os.path.join(base_dir, "features.bundle"),  # all labelled subjects packed for training
+        "trace": os.path.join(base_dir, "trace.jsonl"),  # stage timings, see TRACE
+    }
+    for key in ["handcrafted", "gnn", "channels"]:
+        os.makedirs(layout[key], exist_ok=True)
+    return layout
+
+def preprocess_params():
+    """Everything that changes the preprocessed (filtered, resampled) signal of the preloaded path."""
+    return {
+        "filter_band": list(FILTER_BAND),
+        "fir_design": "firwin",
+        "sampling_rate": SAMPLING_RATE,
+        "resample_method": "fft",
+        "npad": "auto",
+    }
+
+def extraction_params():
+    """Everything that changes the saved features; fingerprinted into the manifest."""
+    return {
+        "filter_band": list(FILTER_BAND),
+        "sampling_rate": SAMPLING_RATE,
+        # The preloaded path computes features from the float32 cached signal when the cache is on
+        "preprocessed_dtype": "float32" if PREPROCESS_CACHE and not STREAMING else "float64",
+        "compute_dtype": "float32" if FLOAT32 else "float64",
+        "epoch_duration": EPOCH_DURATION,
+        "epoch_overlap": EPOCH_OVERLAP,
+        # FFT resampling is global; streaming needs the local polyphase resampler
+        "resample_method": "polyphase" if STREAMING else "fft",
+        "frequency_bands": {band: list(rng) for band, rng in FREQUENCY_BANDS.items()},
+        "psd_method": PSD_METHOD,
+        "screening": {"flat_ptp": FLAT_PTP, "reject_ptp": REJECT_PTP, "reject_var_ratio": REJECT_VAR_RATIO}
+                     if SCREEN_EPOCHS else None,
+        "connectivity": ["coherence", "plv"] if CONNECTIVITY else None,
+    }
+
 #############################################
-# 1) LOAD PARTICIPANT LABELS
+# 1) DATASET CATALOG
 #############################################
-def load_participant_labels(ds004504_file, ds003800_file):
-    label_dict = {}
-    # Only include groups "A" and "C"
-    group_map_ds004504 = {"A": 1, "C": 0}
-    df_ds004504 = pd.read_csv(ds004504_file, sep="\t")
-    df_ds004504 = df_ds004504[df_ds004504['Group'] != 'F']
-    df_ds004504 = df_ds004504[df_ds004504['Group'].isin(group_map_ds004504.keys())]
-    labels_ds004504 = df_ds004504.set_index("participant_id")["Group"].map(group_map_ds004504).to_dict()
-    label_dict.update(labels_ds004504)
-    df_ds003800 = pd.read_csv(ds003800_file, sep="\t")
-    labels_ds003800 = df_ds003800.set_index("participant_id")["Group"].apply(lambda x: 1).to_dict()
-    label_dict.update(labels_ds003800)
-    return label_dict
-
-participant_labels = load_participant_labels(PARTICIPANTS_FILE_DS004504, PARTICIPANTS_FILE_DS003800)
+def open_catalog(rebuild=False):
+    """Catalog of both datasets; a dataset is only rescanned when it changed (see catalog.py)."""
+    return Catalog(CATALOG_PATH, rebuild=rebuild)
 
 #############################################
 # 2) HANDCRAFTED FEATURE EXTRACTION FUNCTIONS
 #############################################
+# Columns of extract_features_batch
+HANDCRAFTED_FEATURE_NAMES = list(FREQUENCY_BANDS.keys()) + [
+    "Alpha_Ratio", "Theta_Ratio", "Shannon_Entropy",
+    "Hjorth_Activity", "Hjorth_Mobility", "Hjorth_Complexity",
+]
+
+def compute_dtype():
+    return np.float32 if FLOAT32 else np.float64
+
 def compute_band_powers(data, sfreq):
-    psd, freqs = mne.time_frequency.psd_array_multitaper(data, sfreq=sfreq, verbose=False)
-    band_powers = {band: np.mean(psd[:, :, (freqs >= fmin) & (freqs <= fmax)], axis=2)
-                   for band, (fmin, fmax) in FREQUENCY_BANDS.items()}
-    return band_powers
+    bands = compute_band_tensor(data, sfreq, FREQUENCY_BANDS, method=PSD_METHOD)
+    return {band: bands[..., b] for b, band in enumerate(FREQUENCY_BANDS)}
 
 def compute_shannon_entropy(data):
-    def entropy_fn(x):
-        counts, _ = np.histogram(x, bins=256)
-        p = counts / np.sum(counts)
-        return -np.sum(p * np.log2(p + 1e-12))
-    return np.apply_along_axis(entropy_fn, 1, data)
+    """Across-channel histogram entropy averaged over time, per epoch."""
+    return fused_signal_features(data)["shannon_entropy"]
 
-@njit
 def compute_hjorth_parameters_numba(data):
-    n_epochs, n_channels, n_times = data.shape
-    activities = np.empty(n_epochs, dtype=np.float64)
-    mobilities = np.empty(n_epochs, dtype=np.float64)
-    complexities = np.empty(n_epochs, dtype=np.float64)
-    for i in range(n_epochs):
-        var0 = np.empty(n_channels, dtype=np.float64)
-        for j in range(n_channels):
-            s = 0.0
-            for k in range(n_times):
-                s += data[i, j, k]
-            mean_val = s / n_times
-            s2 = 0.0
-            for k in range(n_times):
-                diff = data[i, j, k] - mean_val
-                s2 += diff * diff
-            var0[j] = s2 / n_times
-            if var0[j] < 1e-12:
-                var0[j] = 1e-12
-        mobility = np.empty(n_channels, dtype=np.float64)
-        for j in range(n_channels):
-            s2 = 0.0
-            for k in range(1, n_times):
-                diff = data[i, j, k] - data[i, j, k-1]
-                s2 += diff * diff
-            mobility[j] = np.sqrt(s2 / ((n_times - 1) * var0[j]))
-        complexity = np.empty(n_channels, dtype=np.float64)
-        for j in range(n_channels):
-            s2 = 0.0
-            for k in range(2, n_times):
-                diff1 = data[i, j, k-1] - data[i, j, k-2]
-                diff2 = data[i, j, k] - data[i, j, k-1]
-                second_diff = diff2 - diff1
-                s2 += second_diff * second_diff
-            if s2 < 1e-12:
-                s2 = 1e-12
-            complexity[j] = np.sqrt(s2 / (n_times - 2)) / (mobility[j] + 1e-12)
-        activities[i] = np.mean(var0)
-        mobilities[i] = np.mean(mobility)
-        complexities[i] = np.mean(complexity)
-    return activities, mobilities, complexities
+    """Per-epoch channel-averaged Hjorth activity, mobility and complexity."""
+    feats = fused_signal_features(data)
+    return feats["hjorth_activity"], feats["hjorth_mobility"], feats["hjorth_complexity"]
+
+def extract_features_batch(data, band_tensor, signal_feats=None):
+    """
+    Handcrafted features for every epoch of data (n_epochs, n_channels, n_times).
+    band_tensor is the matching (n_epochs, n_channels, n_bands) band-power tensor;
+    signal_feats the fused kernel features of data, if already computed (data
+    is then not read and may be None).
+    """
+    band_names = list(FREQUENCY_BANDS.keys())
+    band_means = np.mean(band_tensor, axis=1)  # average over channels
+    alpha_power = band_means[:, band_names.index("Alpha1")] + band_means[:, band_names.index("Alpha2")]
+    theta_power = band_means[:, band_names.index("Theta1")] + band_means[:, band_names.index("Theta2")]
+    total_power = np.sum(band_means, axis=1) + 1e-12
+    # Entropy and Hjorth parameters from one fused kernel pass
+    if signal_feats is None:
+        with stage("signal_kernels"):
+            signal_feats = fused_signal_features(data)
+    features = np.column_stack([
+        band_means,
+        alpha_power/total_power, theta_power/total_power,
+        signal_feats["shannon_entropy"],
+        signal_feats["hjorth_activity"], signal_feats["hjorth_mobility"], signal_feats["hjorth_complexity"]
+    ])
+    return features.astype(np.float32)
 
 def extract_features_epoch(epoch_data):
     data = epoch_data[np.newaxis, :, :]
-    band_powers = compute_band_powers(data, SAMPLING_RATE)
-    features = [np.mean(band_powers[band]) for band in FREQUENCY_BANDS.keys()]
-    alpha_power = np.mean(band_powers["Alpha1"]) + np.mean(band_powers["Alpha2"])
-    theta_power = np.mean(band_powers["Theta1"]) + np.mean(band_powers["Theta2"])
-    total_power = sum(np.mean(band_powers[band]) for band in FREQUENCY_BANDS.keys()) + 1e-12
-    features.extend([alpha_power/total_power, theta_power/total_power])
-    sh_entropy = np.mean(compute_shannon_entropy(data))
-    features.append(sh_entropy)
-    act, mob, comp = compute_hjorth_parameters_numba(data)
-    features.extend([np.mean(act), np.mean(mob), np.mean(comp)])
-    return np.array(features, dtype=np.float32)
+    return extract_features_batch(data, compute_band_tensor(data, SAMPLING_RATE, FREQUENCY_BANDS, method=PSD_METHOD))[0]
 
 #############################################
 # 3) GNN CHANNEL-FEATURE EXTRACTION
 #############################################
+def extract_channel_features_GNN_batch(band_tensor):
+    """Channel-level band powers, (n_epochs, n_channels, n_bands), as float32."""
+    return band_tensor.astype(np.float32)
+
 def extract_channel_features_GNN_epoch(epoch_data, sfreq):
-    n_channels = epoch_data.shape[0]
-    features = np.zeros((n_channels, len(FREQUENCY_BANDS)), dtype=np.float32)
-    for ch in range(n_channels):
-        ts = epoch_data[ch, :]
-        psd, freqs = mne.time_frequency.psd_array_multitaper(
-            ts[np.newaxis, :], sfreq=sfreq, verbose=False
-        )
-        band_vals = []
-        for (fmin, fmax) in FREQUENCY_BANDS.values():
-            idx = (freqs >= fmin) & (freqs <= fmax)
-            band_vals.append(np.mean(psd[0, idx]))
-        features[ch, :] = np.array(band_vals, dtype=np.float32)
-    return features
-
-#############################################
-# 4) COMBINED PROCESSING (HANDCRAFTED + GNN)
+    return extract_channel_features_GNN_batch(compute_band_tensor(epoch_data, sfreq, FREQUENCY_BANDS, method=PSD_METHOD))
+
+#############################################
+# 4) EPOCH SOURCES (PRELOADED OR STREAMING)
+#############################################
+def screen_epochs(stats):
+    """
+    Artifact screening on signal_stats statistics, (n_epochs, n_channels, N_STATS):
+    (keep mask over epochs, {check: mask of epochs failing it}).
+    """
+    if not SCREEN_EPOCHS:
+        return np.ones(len(stats), dtype=bool), {}
+    ptp = stats[..., STAT_PTP]
+    var = stats[..., STAT_VAR]
+    checks = {
+        "flat": (ptp < FLAT_PTP).any(axis=1),
+        "ptp": (ptp > REJECT_PTP).any(axis=1),
+        "variance": (var > REJECT_VAR_RATIO * np.median(var, axis=1, keepdims=True)).any(axis=1),
+    }
+    return ~np.logical_or.reduce(list(checks.values())), checks
+
+def screening_record(keep, checks):
+    """Rejection statistics of one subject, as stored in the manifest."""
+    return {
+        "n_epochs": int(len(keep)),
+        "n_rejected": int(np.count_nonzero(~keep)),
+        "rejected_epochs": np.flatnonzero(~keep).tolist(),  # among the epochs left after 'bad' spans
+        "failed_checks": {name: int(np.count_nonzero(mask)) for name, mask in checks.items()},
+    }
+
+def compute_epoch_features(data, data_lap, signal_feats=None):
+    """
+    Per-epoch handcrafted and GNN features for (n_epochs, n_channels, n_times)
+    arrays, from one multitaper pass over both montages (stacked along channels).
+    signal_feats: the fused kernel features of data, if already computed.
+    """
+    data = data.astype(compute_dtype(), copy=False)
+    data_lap = data_lap.astype(compute_dtype(), copy=False)
+    n_channels = data.shape[1]
+    with stage("psd"):
+        band_tensor = compute_band_tensor(np.concatenate((data, data_lap), axis=1), SAMPLING_RATE, FREQUENCY_BANDS,
+                                          method=PSD_METHOD)
+    hand = extract_features_batch(data, band_tensor[:, :n_channels], signal_feats)
+    gnn = extract_channel_features_GNN_batch(band_tensor[:, n_channels:])
+    return hand, gnn
+
+def load_preprocessed(file):
+    """
+    Band-passed signal at SAMPLING_RATE, (n_channels, n_samples), with its info
+    and bad spans. Served from the preprocessed cache when present (a float32
+    memmap, no decoding or filtering), otherwise computed and, if
+    PREPROCESS_CACHE is on, stored there. Callers converting to float64 copy it.
+    """
+    cache = PreprocessedCache(PREPROCESSED_DIR, preprocess_params()) if PREPROCESS_CACHE else None
+    if cache is not None:
+        with stage("read_cache"):
+            cached = cache.load(file)
+        if cached is not None:
+            return cached
+    with stage("read"):
+        raw = mne.io.read_raw_eeglab(file, preload=True, verbose=False)
+    with stage("filter"):
+        raw.filter(*FILTER_BAND, fir_design="firwin", verbose=False)
+    with stage("resample"):
+        raw.resample(SAMPLING_RATE, npad="auto")
+    if cache is not None:
+        with stage("write_cache"):
+            return cache.save(file, raw.get_data(), raw.info, _bad_spans(raw))
+    return raw.get_data(), raw.info, _bad_spans(raw)
+
+def epoch_geometry():
+    """(epoch length, hop) in samples at SAMPLING_RATE."""
+    return int(round(EPOCH_DURATION * SAMPLING_RATE)), int(round((EPOCH_DURATION - EPOCH_OVERLAP) * SAMPLING_RATE))
+
+def epoch_starts(n_samples, bad_spans):
+    """
+    Start samples of the fixed-length epochs of a signal at SAMPLING_RATE, cut
+    as make_fixed_length_epochs does (epochs overlapping 'bad' spans dropped).
+    """
+    epoch_len, step = epoch_geometry()
+    if n_samples < epoch_len:
+        return np.empty(0, dtype=np.int64)
+    n_epochs = (n_samples - epoch_len) // step + 1
+    return np.array([k * step for k in range(n_epochs)
+                     if not any(s < k * step / SAMPLING_RATE + EPOCH_DURATION and e > k * step / SAMPLING_RATE
+                                for s, e in bad_spans)], dtype=np.int64)
+
+def cut_epochs(signal, starts):
+    """(n_epochs, n_channels, epoch length) copy of the epochs starting at `starts`."""
+    epoch_len, _ = epoch_geometry()
+    return np.stack([signal[:, s:s + epoch_len] for s in starts])
+
+def epoch_band_tensor(signal, signal_lap, starts):
+    """
+    Band powers (n_epochs, 2 * n_channels, n_bands) of the epochs at `starts`,
+    both montages stacked along channels. With Welch and a hop on the segment
+    grid, each segment of the signal is transformed once however much the
+    epochs overlap; otherwise epochs are cut and transformed EPOCH_BATCH at a time.
+    """
+    epoch_len, step = epoch_geometry()
+    if shares_segments(epoch_len, step, PSD_METHOD):
+        seg_bands = np.concatenate((segment_band_powers(signal, SAMPLING_RATE, FREQUENCY_BANDS),
+                                    segment_band_powers(signal_lap, SAMPLING_RATE, FREQUENCY_BANDS)))
+        return window_band_powers(seg_bands, starts, epoch_len)
+    bands = []
+    for b in range(0, len(starts), EPOCH_BATCH):
+        batch = starts[b:b + EPOCH_BATCH]
+        data = np.concatenate((cut_epochs(signal, batch), cut_epochs(signal_lap, batch)), axis=1)
+        bands.append(compute_band_tensor(data, SAMPLING_RATE, FREQUENCY_BANDS, method=PSD_METHOD))
+    return np.concatenate(bands)
+
+def subject_connectivity(signal_lap, starts):
+    """
+    (coherence, plv) per band over the Welch segments of the epochs at
+    `starts`, each segment counted once when epochs overlap.
+    """
+    epoch_len, _ = epoch_geometry()
+    offsets = np.arange(0, epoch_len - WELCH_N_FFT + 1, WELCH_N_FFT)
+    seg_starts = np.unique((starts[:, np.newaxis] + offsets).ravel())
+    acc = ConnectivityAccumulator(signal_lap.shape[0], SAMPLING_RATE)
+    per_batch = EPOCH_BATCH * len(offsets)
+    for b in range(0, len(seg_starts), per_batch):
+        batch = seg_starts[b:b + per_batch]
+        acc.add(signal_lap[:, batch[:, np.newaxis] + np.arange(WELCH_N_FFT)].transpose(1, 0, 2))
+    return acc.band_connectivity(FREQUENCY_BANDS)
+
+def extract_subject_epochs(file):
+    """
+    Preloaded path: whole recording in memory. The time-domain statistics of all
+    epochs come from one kernel pass over the continuous signal and CSD is
+    applied to it once, so overlapping epochs repeat neither (see also
+    epoch_band_tensor).
+    """
+    signal, info, bad_spans = load_preprocessed(file)
+    starts = epoch_starts(signal.shape[1], bad_spans)
+    if len(starts) == 0:
+        raise ValueError("No data extracted from epochs.")
+    epoch_len, _ = epoch_geometry()
+    signal = np.asarray(signal, dtype=compute_dtype())  # a view of the cache map only with FLOAT32
+    n_channels = signal.shape[0]
+
+    # One kernel pass gives both the screening statistics and the entropy/Hjorth features
+    with stage("signal_kernels"):
+        stats, time_entropy = window_signal_stats(signal, starts, epoch_len)
+    with stage("screen"):
+        keep, checks = screen_epochs(stats)
+    if not keep.any():
+        raise ValueError(f"All {len(keep)} epochs rejected by artifact screening.")
+    starts, stats, time_entropy = starts[keep], stats[keep], time_entropy[keep]
+
+    # GNN branch input: Laplacian montage (CSD) as a cached per-montage linear map
+    with stage("csd"):
+        signal_lap = apply_csd(signal, csd_operator(info, CSD_CACHE_DIR))
+    with stage("psd"):
+        band_tensor = epoch_band_tensor(signal, signal_lap, starts)
+    epoch_hand_features = extract_features_batch(None, band_tensor[:, :n_channels],
+                                                 features_from_stats(stats, time_entropy, epoch_len))
+    gnn_epoch_features = extract_channel_features_GNN_batch(band_tensor[:, n_channels:])
+    connectivity = None
+    if CONNECTIVITY:
+        with stage("connectivity"):
+            connectivity = subject_connectivity(signal_lap, starts)
+    return epoch_hand_features, gnn_epoch_features, info.ch_names, screening_record(keep, checks), connectivity
+
+def _bad_spans(raw):
+    """(start, stop) in seconds from the first sample, for annotations starting with 'bad'."""
+    annot = raw.annotations
+    offset = raw.first_time if annot.orig_time is not None else 0.0
+    return [(onset - offset, onset - offset + duration)
+            for onset, duration, desc in zip(annot.onset, annot.duration, annot.description)
+            if desc.lower().startswith("bad")]
+
+def _stream_chunk_epochs(n_channels, sfreq, memory_budget_mb):
+    """How many epochs fit in one chunk under the memory budget."""
+    # float64 working set: raw chunk, filtered copy, filter buffers, resampled + CSD copies
+    per_epoch = n_channels * EPOCH_DURATION * sfreq * 8 * 4
+    margins = n_channels * 2 * STREAM_MARGIN * sfreq * 8 * 4
+    return max(1, int((memory_budget_mb * 1024**2 - margins) // per_epoch))
+
+def iter_epochs_streaming(raw, memory_budget_mb=STREAM_MEMORY_BUDGET_MB):
+    """
+    Yield (epoch, epoch_lap) pairs of shape (n_channels, n_times) at SAMPLING_RATE.
+
+    raw must not be preloaded. Chunks of whole epochs are read with STREAM_MARGIN
+    seconds of context on each side, band-passed, polyphase-resampled, CSD
+    transformed, trimmed and cut into epochs, so only one chunk is in memory at
+    a time. Both the FIR filter and the polyphase resampler are local, so the
+    epochs match whole-recording processing with the same resampler. Epochs
+    overlapping 'bad' annotations are skipped, as make_fixed_length_epochs does.
+    """
+    sfreq = raw.info["sfreq"]
+    ratio = Fraction(SAMPLING_RATE) / Fraction(sfreq).limit_denominator(10000)
+    # Chunks span a multiple of `grid` input samples so each resamples to an
+    # exact number of output samples (no per-chunk rate rounding)
+    grid = ratio.denominator
+    epoch_in = int(round(EPOCH_DURATION * sfreq))
+    epoch_out = int(round(EPOCH_DURATION * SAMPLING_RATE))
+    step_in = int(round((EPOCH_DURATION - EPOCH_OVERLAP) * sfreq))
+    step_out = int(round((EPOCH_DURATION - EPOCH_OVERLAP) * SAMPLING_RATE))
+    margin_in = int(round(STREAM_MARGIN * sfreq))
+    if step_in % grid or margin_in % grid or step_in * ratio != step_out:
+        raise ValueError(f"Streaming needs epoch and margin boundaries on both the {sfreq} Hz "
+                         f"and {SAMPLING_RATE} Hz sample grids.")
+    n_out = int(raw.n_times * ratio)
+    n_epochs = (n_out - epoch_out) // step_out + 1 if n_out >= epoch_out else 0
+
+    info_out = mne.create_info(raw.ch_names, SAMPLING_RATE, raw.get_channel_types())
+    info_out.set_montage(raw.get_montage())
+    csd = csd_operator(info_out, CSD_CACHE_DIR)
+    bad_spans = _bad_spans(raw)
+    per_chunk = _stream_chunk_epochs(len(raw.ch_names), sfreq, memory_budget_mb)
+
+    for e0 in range(0, n_epochs, per_chunk):
+        e1 = min(e0 + per_chunk, n_epochs)
+        start = e0 * step_in
+        stop = (e1 - 1) * step_in + epoch_in
+        a = max(0, start - margin_in)
+        b = min(raw.n_times, stop + margin_in)
+        b = a + (b - a) // grid * grid
+        with stage("read"):
+            chunk = raw.get_data(start=a, stop=b)
+        with stage("filter"):
+            chunk = mne.filter.filter_data(chunk, sfreq, *FILTER_BAND, fir_design="firwin", copy=False, verbose=False)
+        with stage("resample"):
+            chunk = mne.filter.resample(chunk, up=SAMPLING_RATE, down=sfreq, npad="auto",
+                                        method="polyphase", verbose=False)
+        with stage("csd"):
+            chunk_lap = apply_csd(chunk, csd)
+        offset = int(round((start - a) * ratio))
+        for i in range(e1 - e0):
+            t0 = (e0 + i) * (EPOCH_DURATION - EPOCH_OVERLAP)
+            if any(s < t0 + EPOCH_DURATION and e > t0 for s, e in bad_spans):
+                continue
+            lo = offset + i * step_out
+            yield chunk[:, lo:lo + epoch_out], chunk_lap[:, lo:lo + epoch_out]
+        del chunk, chunk_lap
+
+def extract_subject_epochs_streaming(file, memory_budget_mb=STREAM_MEMORY_BUDGET_MB):
+    """Streaming path: epochs are screened and go through the feature kernels one at a time."""
+    with stage("read"):
+        raw = mne.io.read_raw_eeglab(file, preload=False, verbose=False)
+    hand, gnn, keep, checks = [], [], [], {}
+    conn = ConnectivityAccumulator(len(raw.ch_names), SAMPLING_RATE) if CONNECTIVITY else None
+    for epoch, epoch_lap in iter_epochs_streaming(raw, memory_budget_mb):
+        epoch = epoch[np.newaxis].astype(compute_dtype(), copy=False)
+        with stage("signal_kernels"):
+            stats, time_entropy = signal_stats(epoch)
+        with stage("screen"):
+            epoch_keep, epoch_checks = screen_epochs(stats)
+        keep.append(epoch_keep[0])
+        for name, mask in epoch_checks.items():
+            checks.setdefault(name, []).append(mask[0])
+        if not epoch_keep[0]:
+            continue
+        h, g = compute_epoch_features(epoch, epoch_lap[np.newaxis],
+                                      features_from_stats(stats, time_entropy, epoch.shape[-1]))
+        hand.append(h[0])
+        gnn.append(g[0])
+        if conn is not None:
+            with stage("connectivity"):
+                n_seg = epoch_lap.shape[1] // WELCH_N_FFT
+                conn.add(epoch_lap[:, :n_seg * WELCH_N_FFT].reshape(-1, n_seg, WELCH_N_FFT).transpose(1, 0, 2))
+    if not keep:
+        raise ValueError("No data extracted from epochs.")
+    if not hand:
+        raise ValueError(f"All {len(keep)} epochs rejected by artifact screening.")
+    screening = screening_record(np.array(keep), {name: np.array(m) for name, m in checks.items()})
+    connectivity = conn.band_connectivity(FREQUENCY_BANDS) if conn is not None else None
+    return np.array(hand), np.array(gnn), raw.ch_names, screening, connectivity
+
+#############################################
+# 5) COMBINED PROCESSING (HANDCRAFTED + GNN)
 #############################################
 def process_subject_combined(args):
     file, label = args
     try:
-        raw = mne.io.read_raw_eeglab(file, preload=True, verbose=False)
-        raw.filter(1.0, 50.0, fir_design="firwin", verbose=False)
-        raw.resample(SAMPLING_RATE, npad="auto")
-        # Create fixed-length epochs (adjust overlap if needed)
-        epochs = mne.make_fixed_length_epochs(raw, duration=20.0, overlap=0.0, verbose=False)
-        data = epochs.get_data()
-        if data.size == 0:
-            raise ValueError("No data extracted from epochs.")
-
-        # Handcrafted branch: compute per-epoch features then aggregate (mean & std)
-        epoch_hand_features = np.array([extract_features_epoch(epoch) for epoch in data])
+        if STREAMING:
+            epoch_hand_features, gnn_epoch_features, ch_names, screening, connectivity = \
+                extract_subject_epochs_streaming(file)
+        else:
+            epoch_hand_features, gnn_epoch_features, ch_names, screening, connectivity = extract_subject_epochs(file)
+
+        # Handcrafted branch: aggregate per-epoch features (mean & std)
         mean_features = np.mean(epoch_hand_features, axis=0)
         std_features = np.std(epoch_hand_features, axis=0)
         handcrafted_global = np.hstack((mean_features, std_features))
 
-        # GNN branch: apply Laplacian montage then extract channel-level features per epoch
-        raw_lap = raw.copy()
-        raw_lap = mne.preprocessing.compute_current_source_density(raw_lap)
-        epochs_lap = mne.make_fixed_length_epochs(raw_lap, duration=20.0, overlap=0.0, verbose=False)
-        data_lap = epochs_lap.get_data()
-        gnn_epoch_features = np.array([extract_channel_features_GNN_epoch(epoch, SAMPLING_RATE) for epoch in data_lap])
         # Aggregate GNN features over epochs (by taking the mean)
         gnn_aggregated = np.mean(gnn_epoch_features, axis=0)
-        ch_names = raw_lap.ch_names
 
-        return handcrafted_global, epoch_hand_features, gnn_aggregated, label, ch_names
+        return (handcrafted_global, epoch_hand_features, gnn_aggregated, gnn_epoch_features, label, ch_names,
+                screening, connectivity)
     except Exception as e:
         print(f"[ERROR] Processing failed for {file}: {e}")
-        return None, None, None, None, None
-
-#############################################
-# 5) LOAD DATASET IN PARALLEL & SAVE OUTPUTS
-#############################################
-def main():
-    # Collect .set files from both datasets
-    dataset_paths = [DS004504_PATH, DS003800_PATH]
-    all_files = []
-    for path in dataset_paths:
-        pattern = os.path.join(path, "**", "*_task-Rest_eeg.set") if 'ds003800' in path else os.path.join(path, "**", "*.set")
-        files = glob.glob(pattern, recursive=True)
-        all_files.extend(files)
-
-    # Build tasks: only include files for which the subject ID is found in participant_labels.
-    tasks = []
-    for f in all_files:
-        subj = os.path.basename(f).split('_')[0]
-        label = participant_labels.get(subj, None)
-        if label is None:
-            print(f"[DEBUG] Skipping {f} because subject {subj} not found in labels.")
-        else:
-            tasks.append((f, label))
-    print(f"[INFO] Found {len(tasks)} files to process.")  # Expected: 76 subjects
-
-    processed_subjects = []
-    # Process files in parallel
-    with ProcessPoolExecutor(max_workers=4) as executor:
-        results = list(tqdm(executor.map(process_subject_combined, tasks), total=len(tasks)))
-    for res in results:
-        if res[0] is not None and res[2] is not None:
-            processed_subjects.append(res)
-    print(f"[INFO] Successfully processed {len(processed_subjects)} subjects.")
-
-    # Save outputs for each processed subject
-    for res, task in zip(processed_subjects, tasks):
-        file, _ = task
-        subj_id = os.path.basename(file).split('_')[0]
-        handcrafted_global, epoch_features, gnn_aggregated, label, ch_names = res
-        np.save(os.path.join(HANDCRAFTED_DIR, f"{subj_id}_handcrafted.npy"), handcrafted_global)
-        np.save(os.path.join(GNN_DIR, f"{subj_id}_gnn.npy"), gnn_aggregated)
-        with open(os.path.join(CHANNELS_DIR, f"{subj_id}_channels.json"), "w") as fp:
-            json.dump(ch_names, fp)
-        print(f"[INFO] Saved features for subject {subj_id}")
-
-    print(f"[DONE] Processed and saved features for {len(processed_subjects)} subjects.")
+        return None, None, None, None, None, None, None, None
+
+def subject_id(file):
+    return os.path.basename(file).split('_')[0]
+
+def save_subject_outputs(subj_id, handcrafted_global, gnn_aggregated, ch_names, layout, connectivity=None):
+    """Atomically write one subject's summary outputs (connectivity: (coherence, plv) or None); returns their paths."""
+    outputs = {
+        "handcrafted": os.path.join(layout["handcrafted"], f"{subj_id}_handcrafted.npy"),
+        "gnn": os.path.join(layout["gnn"], f"{subj_id}_gnn.npy"),
+        "channels": os.path.join(layout["channels"], f"{subj_id}_channels.json"),
+    }
+    atomic_save_npy(outputs["handcrafted"], handcrafted_global)
+    atomic_save_npy(outputs["gnn"], gnn_aggregated)
+    atomic_save_json(outputs["channels"], ch_names)
+    if connectivity is not None:
+        for name, matrices in zip(("coherence", "plv"), connectivity):
+            outputs[name] = os.path.join(layout["gnn"], f"{subj_id}_{name}.npy")
+            atomic_save_npy(outputs[name], matrices)
+    return outputs
+
+def extract_and_save_subject(args):
+    """
+    Worker entry point: process one recording and write its outputs from the
+    worker itself. Only the subject ID, output paths, the small per-epoch
+    matrices (for the single-writer epoch store) and the stage trace travel
+    back to the parent. The result is None if processing failed.
+    The output layout travels with the task: spawned workers re-import this
+    module and would not see a layout chosen at run time.
+    """
+    file, label, layout = args
+    subj_id = subject_id(file)
+    if TRACE:
+        start_trace()
+    handcrafted_global, epoch_features, gnn_aggregated, gnn_epoch_features, label, ch_names, screening, \
+        connectivity = process_subject_combined((file, label))
+    result = None
+    if handcrafted_global is not None and gnn_aggregated is not None:
+        with stage("save"):
+            outputs = save_subject_outputs(subj_id, handcrafted_global, gnn_aggregated, ch_names, layout,
+                                           connectivity)
+        result = {
+            "outputs": outputs,
+            "label": label,
+            "screening": screening,
+            "epoch_features": {"handcrafted": epoch_features, "gnn": gnn_epoch_features},
+        }
+    return subj_id, result, stop_trace()
+
+#############################################
+# 6) LOAD DATASET IN PARALLEL & SAVE OUTPUTS
+#############################################
+def collect_tasks(catalog):
+    """(file, label) for every labelled recording of both datasets."""
+    tasks = [(rec["path"], rec["label"]) for rec in catalog.recordings()]
+    n_unlabelled = len(catalog.recordings(labelled=False)) - len(tasks)
+    print(f"[INFO] Found {len(tasks)} files to process "
+          f"({n_unlabelled} recordings of unlabelled subjects skipped).")  # Expected: 76 subjects
+    return tasks
+
+def estimate_task_memory_mb(record, input_bytes):
+    """Estimated peak RSS of one worker processing this recording (record: its catalog entry, or None)."""
+    if STREAMING:
+        return WORKER_BASE_MB + STREAM_MEMORY_BUDGET_MB
+    meta = record or {"n_channels": None, "sfreq": None, "duration": None}
+    if meta["n_channels"] and meta["sfreq"] and meta["duration"]:
+        n_in = meta["n_channels"] * meta["sfreq"] * meta["duration"]
+    else:
+        n_in = input_bytes / 4  # EEGLAB stores float32 samples
+    # Unknown rate: assume no downsampling, which can only overestimate
+    n_out = n_in * SAMPLING_RATE / (meta["sfreq"] or SAMPLING_RATE)
+    # The output-rate working set is (almost) all in the compute precision
+    per_out = PRELOAD_BYTES_PER_OUTPUT_SAMPLE * (0.5 if FLOAT32 else 1.0)
+    return WORKER_BASE_MB + (PRELOAD_BYTES_PER_INPUT_SAMPLE * n_in + per_out * n_out) / 1024**2
+
+def save_feature_bundle(manifest, layout):
+    """
+    Pack the summary outputs of every labelled subject in the manifest into
+    layout["bundle"]. Subjects extracted with other parameters than the
+    manifest's current ones (e.g. whose re-extraction failed) are left out.
+    """
+    params_hash = params_fingerprint(manifest["params"])
+    subj_ids, handcrafted, gnn, ch_names, labels = [], [], [], [], []
+    n_stale = 0
+    for subj_id, entry in sorted(manifest["subjects"].items()):
+        outputs = entry["outputs"]
+        if entry.get("label") is None or not all(os.path.exists(outputs[k]) for k in ["handcrafted", "gnn", "channels"]):
+            continue
+        if entry.get("params_hash") != params_hash:
+            n_stale += 1
+            continue
+        with open(outputs["channels"], "r") as fp:
+            ch_names.append(json.load(fp))
+        handcrafted.append(np.load(outputs["handcrafted"]))
+        gnn.append(np.load(outputs["gnn"]))
+        labels.append(entry["label"])
+        subj_ids.append(subj_id)
+    if n_stale:
+        print(f"[WARNING] {n_stale} subjects left out of the feature bundle: extracted with other parameters.")
+    if not subj_ids:
+        if os.path.exists(layout["bundle"]):
+            os.remove(layout["bundle"])  # never leave a bundle of other parameters behind
+        return
+    write_feature_bundle(layout["bundle"], subj_ids, np.stack(handcrafted), gnn, ch_names, labels, params_hash,
+                         manifest["params"].get("psd_method", "multitaper"))
+    print(f"[INFO] Feature bundle with {len(subj_ids)} subjects written to {layout['bundle']}")
+
+def init_worker(n_threads):
+    """Process-pool initializer: cap the thread pools, then load the cached kernels before the first task."""
+    limit_threads(n_threads)
+    warm_up_kernels()
+
+def run_extraction(tasks, layout, shard=None, max_workers=MAX_WORKERS, memory_budget_mb=MEMORY_BUDGET_MB):
+    """Extract and save every task that is not up to date in the layout's manifest."""
+    # Skip subjects whose inputs and preprocessing parameters match the manifest
+    manifest = load_manifest(layout["manifest"])
+    relocate_inputs(manifest, DATA_ROOT)
+    manifest["params"] = extraction_params()
+    if shard is not None:
+        manifest["shard"] = {"index": shard[0], "count": shard[1]}
+    params_hash = params_fingerprint(manifest["params"])
+    epoch_store = EpochStoreWriter(layout["epochs"], params_hash)
+    pending = []
+    subject_inputs = {}
+    unreadable = []
+    for f, label in tasks:
+        subj_id = subject_id(f)
+        entry = manifest["subjects"].get(subj_id)
+        try:
+            inputs = describe_inputs(f, entry, DATA_ROOT)
+        except OSError as e:  # e.g. an unfetched git-annex symlink
+            print(f"[ERROR] Cannot read inputs of subject {subj_id}, skipping: {e}")
+            unreadable.append(subj_id)
+            continue
+        if is_up_to_date(entry, inputs, params_hash) and subj_id in epoch_store:
+            continue
+        subject_inputs[subj_id] = inputs
+        pending.append((f, label, layout))
+    print(f"[INFO] {len(tasks) - len(pending) - len(unreadable)} subjects up to date, {len(pending)} to process, "
+          f"{len(unreadable)} unreadable.")
+
+    catalog = open_catalog()
+    estimates = [estimate_task_memory_mb(catalog.recording(f), sum(info["size"] for info in subject_inputs[subject_id(f)].values()))
+                 for f, _, _ in pending]
+    workers, threads = worker_plan(len(pending), max_workers)
+    budget_mb = memory_budget_mb or default_memory_budget_mb()
+    print(f"[INFO] {workers} workers x {threads} threads, memory budget {budget_mb:.0f} MB.")
+    if estimates and max(estimates) > budget_mb:
+        print(f"[WARNING] Largest task needs ~{max(estimates):.0f} MB, over the budget; it will run alone.")
+    estimated_mb = {subject_id(task[0]): est for task, est in zip(pending, estimates)}
+
+    # Workers save their own outputs; each completion is committed to the epoch
+    # store and manifest immediately, so an interrupted run resumes from there.
+    n_saved = 0
+    n_done = 0
+    n_epochs = 0
+    n_rejected = 0
+    bytes_done = 0
+    traces = []
+    t_start = time.time()
+    run_started = time.strftime("%Y-%m-%dT%H:%M:%S")
+    # forkserver, not fork: a forked child of a parent whose parallel kernels have
+    # started Numba's TBB pool keeps the parent from exiting at interpreter shutdown
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(threads,),
+                             mp_context=multiprocessing.get_context("forkserver")) as executor:
+        progress = tqdm(run_packed(executor, extract_and_save_subject, pending, estimates, budget_mb, workers),
+                        total=len(pending))
+        for task, fut in progress:
+            subj_id = subject_id(task[0])
+            trace = None
+            try:
+                _, result, trace = fut.result()
+            except Exception as e:
+                print(f"[ERROR] Saving failed for subject {subj_id}: {e}")
+                result = None
+            if trace is not None:
+                trace.update(subject=subj_id, run_started=run_started, estimated_mb=estimated_mb[subj_id],
+                             status="ok" if result is not None else "failed")
+                append_trace(layout["trace"], trace)
+                traces.append(trace)
+            n_done += 1
+            bytes_done += sum(info["size"] for info in subject_inputs[subj_id].values())
+            if result is not None:
+                try:
+                    epoch_store.append(subj_id, result["epoch_features"])
+                except ValueError as e:
+                    print(f"[ERROR] Storing per-epoch features failed for subject {subj_id}: {e}")
+                    result = None
+            if result is not None:
+                record_subject(manifest, subj_id, subject_inputs[subj_id], params_hash,
+                               result["outputs"], result["label"], result["screening"])
+                n_epochs += result["screening"]["n_epochs"]
+                n_rejected += result["screening"]["n_rejected"]
+                save_manifest(manifest, layout["manifest"])
+                n_saved += 1
+                print(f"[INFO] Saved features for subject {subj_id}")
+            elapsed = max(time.time() - t_start, 1e-9)
+            progress.set_postfix(subj_per_min=f"{60 * n_done / elapsed:.1f}",
+                                 mb_per_s=f"{bytes_done / 1e6 / elapsed:.1f}")
+    save_manifest(manifest, layout["manifest"])
+    epoch_store.compact()
+    if shard is None:  # rewritten with every manifest, so ai_model can trust a bundle no older than it
+        save_feature_bundle(manifest, layout)
+
+    elapsed = max(time.time() - t_start, 1e-9)
+    print(f"[INFO] Throughput: {60 * n_done / elapsed:.1f} subjects/min, "
+          f"{bytes_done / 1e6 / elapsed:.1f} MB/s of input EEG")
+    if SCREEN_EPOCHS:
+        print(f"[INFO] Artifact screening rejected {n_rejected} of {n_epochs} epochs "
+              f"({100 * n_rejected / max(n_epochs, 1):.1f}%).")
+    print_run_summary(traces)
+    print(f"[DONE] Processed and saved features for {n_saved} of {len(pending)} subjects.")
+
+#############################################
+# 7) SHARDED RUNS & MERGE
+#############################################
+def shard_of(subj_id, n_shards):
+    """Deterministic shard of a subject: the same on every machine, whatever the glob order."""
+    return int(hashlib.sha256(subj_id.encode("utf-8")).hexdigest(), 16) % n_shards
+
+def parse_shard(spec):
+    """'i/N' -> (i, N) with 0 <= i < N."""
+    try:
+        index, count = (int(part) for part in spec.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard must look like i/N, got '{spec}'")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Shard index must be in [0, {count}), got '{spec}'")
+    return index, count
+
+def shard_layout(index, count):
+    return output_layout(os.path.join(SHARDS_DIR, f"shard-{index}-of-{count}"))
+
+def merge_shards(layout=None):
+    """
+    Validate the shards under SHARDS_DIR and merge them into the main outputs.
+
+    All shards of one partition (same N, every index present) must have been
+    run with the same extraction parameters, must not share subjects, and
+    every recorded output must exist. Subjects already merged unchanged are
+    skipped, so merging again after re-running a shard only copies its news.
+    """
+    layout = layout or output_layout(BASE_OUTPUT_DIR)
+    shard_dirs = sorted(glob.glob(os.path.join(SHARDS_DIR, "shard-*-of-*")))
+    if not shard_dirs:
+        raise ValueError(f"No shards found in {SHARDS_DIR}")
+    shards = [(output_layout(d), load_manifest(os.path.join(d, "manifest.json"))) for d in shard_dirs]
+
+    counts = {m.get("shard", {}).get("count") for _, m in shards}
+    if len(counts) != 1 or None in counts:
+        raise ValueError(f"Shards in {SHARDS_DIR} come from different partitions: counts {sorted(map(str, counts))}")
+    count = counts.pop()
+    indices = sorted(m["shard"]["index"] for _, m in shards)
+    if indices != list(range(count)):
+        raise ValueError(f"Expected shards 0..{count - 1} of {count}, found {indices}")
+    params = shards[0][1]["params"]
+    if any(m["params"] != params for _, m in shards):
+        raise ValueError("Shards were extracted with different parameters; re-run them with one configuration.")
+    owner = {}
+    for shard, m in shards:
+        for subj_id, entry in m["subjects"].items():
+            if subj_id in owner:
+                raise ValueError(f"Subject {subj_id} appears in both {owner[subj_id]} and {shard['base']}")
+            owner[subj_id] = shard["base"]
+            missing = [p for p in entry["outputs"].values() if not os.path.exists(p)]
+            if missing:
+                raise ValueError(f"Subject {subj_id} in {shard['base']} is missing outputs: {missing}")
+
+    manifest = load_manifest(layout["manifest"])
+    relocate_inputs(manifest, DATA_ROOT)
+    manifest["params"] = params
+    epoch_store = EpochStoreWriter(layout["epochs"], params_fingerprint(params))
+    n_merged = 0
+    for shard, m in shards:
+        shard_store = EpochStore(shard["epochs"])
+        merged = set()
+        for subj_id, entry in m["subjects"].items():
+            if subj_id not in shard_store:
+                raise ValueError(f"Subject {subj_id} in {shard['base']} has no per-epoch features")
+            current = manifest["subjects"].get(subj_id, {})
+            if (subj_id in epoch_store and current.get("completed") == entry["completed"]
+                    and current.get("inputs") == entry["inputs"]
+                    and current.get("params_hash") == entry["params_hash"]):
+                continue
+            outputs = {}
+            for kind, path in entry["outputs"].items():
+                outputs[kind] = os.path.join(layout["base"], os.path.relpath(path, shard["base"]))
+                atomic_copy(path, outputs[kind])
+            families = {name: np.asarray(shard_store.epochs(subj_id, name))
+                        for name in shard_store.index["subjects"][subj_id]}
+            epoch_store.append(subj_id, families)
+            manifest["subjects"][subj_id] = dict(entry, outputs=outputs)
+            save_manifest(manifest, layout["manifest"])
+            merged.add(subj_id)
+        if merged and os.path.exists(shard["trace"]):
+            with open(shard["trace"], "r") as fp:
+                for line in fp:
+                    record = json.loads(line)
+                    if record.get("subject") in merged:
+                        append_trace(layout["trace"], record)
+        print(f"[INFO] Merged {len(merged)} of {len(m['subjects'])} subjects from {shard['base']}")
+        n_merged += len(merged)
+    save_manifest(manifest, layout["manifest"])
+    epoch_store.compact()
+    save_feature_bundle(manifest, layout)
+    print(f"[DONE] Merged {n_merged} subjects from {count} shards into {layout['base']}.")
+
+#############################################
+# 8) FLOAT32 VALIDATION
+#############################################
+FLOAT32_REPORT_PATH = os.path.join(BASE_OUTPUT_DIR, "float32_drift.json")
+
+def _relative_drift(test, reference, axis):
+    """|test - reference| relative to the mean magnitude of the reference along `axis`."""
+    scale = np.mean(np.abs(reference), axis=axis, keepdims=True)
+    return np.abs(test.astype(np.float64) - reference) / np.where(scale > 0, scale, 1.0)
+
+def float32_drift_report(files, path=FLOAT32_REPORT_PATH):
+    """
+    Extract each recording in float64 and in float32 and report how far the
+    float32 features drift: per handcrafted feature, the max relative drift of
+    the per-epoch values and of the per-subject mean/std (what the models see),
+    the max drift of the GNN band powers, and the wall time of both passes.
+    Drift is relative to the feature's mean magnitude over the subject's epochs.
+    Both passes decode and filter the recording in float64 (the preprocessed
+    cache, which stores float32, is bypassed), so wall times include that.
+    """
+    global FLOAT32, SCREEN_EPOCHS, PREPROCESS_CACHE
+    saved = FLOAT32, SCREEN_EPOCHS, PREPROCESS_CACHE
+    SCREEN_EPOCHS = False  # compare both precisions on the same epochs
+    PREPROCESS_CACHE = False  # the float64 reference must not read the float32 cached signal
+    warm_up_kernels()  # so neither pass pays for loading the kernels
+    extract = extract_subject_epochs_streaming if STREAMING else extract_subject_epochs
+    report = {"params": extraction_params(), "subjects": {}}
+    hand_drift, global_drift, gnn_drift = [], [], []
+    try:
+        for f in files:
+            runs = {}
+            for flag in (False, True):
+                FLOAT32 = flag
+                start_trace()
+                hand, gnn, _, _, _ = extract(f)
+                runs[flag] = (hand, gnn, stop_trace()["wall_s"])
+            (hand64, gnn64, wall64), (hand32, gnn32, wall32) = runs[False], runs[True]
+            hand_drift.append(np.max(_relative_drift(hand32, hand64, axis=0), axis=0))
+            glob64 = np.hstack((hand64.mean(axis=0), hand64.std(axis=0)))
+            glob32 = np.hstack((hand32.mean(axis=0), hand32.std(axis=0)))
+            global_drift.append(np.abs(glob32 - glob64) / np.maximum(np.abs(glob64), 1e-300))
+            gnn_drift.append(float(np.max(_relative_drift(gnn32, gnn64, axis=0))))
+            report["subjects"][subject_id(f)] = {"wall_s_float64": wall64, "wall_s_float32": wall32,
+                                                 "gnn_max_rel": gnn_drift[-1]}
+    finally:
+        FLOAT32, SCREEN_EPOCHS, PREPROCESS_CACHE = saved
+
+    n_feat = len(HANDCRAFTED_FEATURE_NAMES)
+    hand_max = np.max(hand_drift, axis=0)
+    global_max = np.max(global_drift, axis=0)
+    report["features"] = {
+        name: {"epoch_max_rel": float(hand_max[i]),
+               "subject_mean_max_rel": float(global_max[i]),
+               "subject_std_max_rel": float(global_max[n_feat + i])}
+        for i, name in enumerate(HANDCRAFTED_FEATURE_NAMES)
+    }
+    report["gnn_max_rel"] = max(gnn_drift)
+    report["wall_s_float64"] = sum(s["wall_s_float64"] for s in report["subjects"].values())
+    report["wall_s_float32"] = sum(s["wall_s_float32"] for s in report["subjects"].values())
+    atomic_save_json(path, report, indent=1)
+
+    print(f"[INFO] float32 drift over {len(files)} subjects (max relative):")
+    print(f"    {'feature':<20} {'epoch':>10} {'subj mean':>10} {'subj std':>10}")
+    for name, d in report["features"].items():
+        print(f"    {name:<20} {d['epoch_max_rel']:10.2e} {d['subject_mean_max_rel']:10.2e} "
+              f"{d['subject_std_max_rel']:10.2e}")
+    print(f"    {'GNN band powers':<20} {report['gnn_max_rel']:10.2e}")
+    print(f"[INFO] Wall time float64 {report['wall_s_float64']:.1f} s, float32 {report['wall_s_float32']:.1f} s")
+    print(f"[DONE] Report written to {path}")
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract handcrafted and GNN EEG features.")
+    parser.add_argument("--shard", metavar="i/N",
+                        help=f"process only the i-th of N deterministic subject partitions, into {SHARDS_DIR}/")
+    parser.add_argument("--merge", action="store_true",
+                        help=f"validate the shards in {SHARDS_DIR}/ and merge them into {BASE_OUTPUT_DIR}/")
+    parser.add_argument("--validate-float32", type=int, metavar="N",
+                        help=f"report float32 vs float64 feature drift on N subjects into {FLOAT32_REPORT_PATH}")
+    parser.add_argument("--rebuild-catalog", action="store_true",
+                        help=f"rescan both datasets into {CATALOG_PATH} (after replacing recordings in place)")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="worker processes (default: CPU cores)")
+    parser.add_argument("--memory-budget-gb", type=float, default=None,
+                        help="RAM for concurrent tasks (default: 80%% of available RAM)")
+    args = parser.parse_args(argv)
+    budget_mb = args.memory_budget_gb * 1024 if args.memory_budget_gb else MEMORY_BUDGET_MB
+
+    if args.merge:
+        merge_shards()
+        return
+    tasks = collect_tasks(open_catalog(rebuild=args.rebuild_catalog))
+    if args.validate_float32:
+        float32_drift_report(sorted(f for f, _ in tasks)[:args.validate_float32])
+        return
+    if args.shard:
+        index, count = parse_shard(args.shard)
+        tasks = [t for t in tasks if shard_of(subject_id(t[0]), count) == index]
+        print(f"[INFO] Shard {index}/{count}: {len(tasks)} files.")
+        run_extraction(tasks, shard_layout(index, count), shard=(index, count),
+                       max_workers=args.workers, memory_budget_mb=budget_mb)
+    else:
+        run_extraction(tasks, output_layout(BASE_OUTPUT_DIR), max_workers=args.workers, memory_budget_mb=budget_mb)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,86 @@
+"""
+Worker Scheduler
+
+Memory-aware task packing for the extraction process pool.
+
+Tasks carry an estimated peak memory. They are started largest first
+(first-fit decreasing): a task is submitted only while the estimates of the
+tasks in flight plus its own stay under the RAM budget, so a few long
+recordings run side by side with short ones instead of all at once, and the
+longest ones do not end up as the tail of the run. A task larger than the whole
+budget still runs, alone.
+
+Each worker caps its BLAS/OpenMP and Numba thread pools (MNE runs single-job
+here, so its heavy lifting goes through those) so that workers x threads does
+not oversubscribe the cores.
+"""
+
+import os
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import numba
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+MEMORY_BUDGET_FRACTION = 0.8  # of the RAM available at start-up
+FALLBACK_MEMORY_BUDGET_MB = 8192  # when psutil is not installed
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+                   "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+#############################################
+# 1) RESOURCES
+#############################################
+def default_memory_budget_mb():
+    if psutil is None:
+        return FALLBACK_MEMORY_BUDGET_MB
+    return psutil.virtual_memory().available / 1024**2 * MEMORY_BUDGET_FRACTION
+
+def worker_plan(n_tasks, max_workers=None):
+    """(workers, threads per worker): one worker per core by default, cores shared out evenly."""
+    cores = os.cpu_count() or 1
+    workers = max(1, min(max_workers or cores, n_tasks or 1))
+    return workers, max(1, cores // workers)
+
+def limit_threads(n_threads):
+    """Process-pool initializer: cap the thread pools of one worker."""
+    # Env vars cover libraries initialised later in the worker; threadpoolctl the
+    # BLAS already loaded when the worker imported numpy.
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(n_threads)
+    if threadpool_limits is not None:
+        threadpool_limits(limits=n_threads)
+    numba.set_num_threads(min(n_threads, numba.config.NUMBA_NUM_THREADS))
+
+#############################################
+# 2) PACKED SUBMISSION
+#############################################
+def run_packed(executor, fn, tasks, costs_mb, budget_mb, max_in_flight):
+    """
+    Run fn(task) on the executor under the memory budget, yielding
+    (task, future) pairs in completion order.
+    """
+    pending = sorted(range(len(tasks)), key=lambda k: costs_mb[k], reverse=True)
+    in_flight = {}
+    used_mb = 0.0
+    while pending or in_flight:
+        i = 0
+        while i < len(pending) and len(in_flight) < max_in_flight:
+            k = pending[i]
+            if in_flight and used_mb + costs_mb[k] > budget_mb:
+                i += 1
+                continue
+            in_flight[executor.submit(fn, tasks[k])] = k
+            used_mb += costs_mb[k]
+            pending.pop(i)
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for fut in done:
+            k = in_flight.pop(fut)
+            used_mb -= costs_mb[k]
+            yield tasks[k], fut
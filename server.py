@@ -7,7 +7,6 @@ Run the server with:
 
 import os
 import numpy as np
-import mne
 import joblib
 import tensorflow as tf
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
@@ -22,6 +21,10 @@ import asyncio
 from collections import deque
 from scipy.interpolate import griddata
 
+from spectral import compute_band_tensor
+from feature_store import load_manifest
+from kernels import signal_stats, warm_up as warm_up_kernels, STAT_MEAN, STAT_VAR, STAT_D1_MEAN, STAT_D1_MS, STAT_D2_MEAN, STAT_D2_MS, STAT_ENTROPY
+
 # For CORS
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -67,6 +70,12 @@ SAMPLING_RATE = 256
 WINDOW_SIZE = 20
 WINDOW_SAMPLES = SAMPLING_RATE * WINDOW_SIZE
 
+# PSD backend for live band powers: "multitaper" (what the models were trained
+# on), or the faster "welch" / "periodogram" for high-rate sliding windows.
+# Must match the psd_method in the processed_features manifest of the models.
+PSD_METHOD = os.environ.get("EEG_PSD_METHOD", "multitaper")
+FEATURES_MANIFEST_PATH = "processed_features/manifest.json"  # written by process_server.py
+
 # Energy landscape config
 GRID_RESOLUTION = 50
 ENERGY_RANGE = 1.0
@@ -110,27 +119,27 @@ class PositionalEncoding(Layer):
 # ------------------ FEATURE EXTRACTION --------------------------------------
 
 def compute_band_powers(data: np.ndarray, sfreq: float) -> Dict[str, float]:
-    psd, freqs = mne.time_frequency.psd_array_multitaper(data, sfreq=sfreq, verbose=False)
-    band_powers = {}
-    for band, (fmin, fmax) in FREQUENCY_BANDS.items():
-        idx_band = (freqs >= fmin) & (freqs <= fmax)
-        # Mean over channels and frequencies
-        band_powers[band] = np.mean(psd[:, idx_band], axis=1).mean()
-    return band_powers
+    # Tapers, frequency grid and band slices come from the cached spectral plan
+    band_tensor = compute_band_tensor(data, sfreq, FREQUENCY_BANDS, method=PSD_METHOD)
+    # Mean over channels and frequencies
+    band_means = band_tensor.mean(axis=0)
+    return {band: float(band_means[b]) for b, band in enumerate(FREQUENCY_BANDS)}
 
 def compute_shannon_entropy(data: np.ndarray) -> float:
-    flattened = data.flatten()
-    counts, _ = np.histogram(flattened, bins=256, density=True)
-    probs = counts / np.sum(counts)
-    entropy_val = -np.sum(probs * np.log2(probs + 1e-12))
-    return entropy_val
+    # Entropy of the pooled sample histogram: the fused kernel's per-channel
+    # histogram entropy of the window flattened into a single row
+    stats, _ = signal_stats(data.reshape(1, 1, -1))
+    return float(stats[0, 0, STAT_ENTROPY])
 
 def compute_hjorth_parameters(data: np.ndarray) -> Dict[str, float]:
-    activity = np.var(data) + 1e-12
-    first_derivative = np.diff(data, axis=-1)
-    mobility = np.sqrt(np.var(first_derivative) / activity)
-    second_derivative = np.diff(first_derivative, axis=-1)
-    complexity = np.sqrt(np.var(second_derivative) / (np.var(first_derivative) + 1e-12))
+    # Pooled (all channels together) moments from the fused kernel's per-channel statistics
+    stats, _ = signal_stats(data[np.newaxis])
+    stats = stats[0]
+    activity = np.mean(stats[:, STAT_VAR]) + np.var(stats[:, STAT_MEAN]) + 1e-12
+    var_d1 = np.mean(stats[:, STAT_D1_MS]) - np.mean(stats[:, STAT_D1_MEAN]) ** 2
+    var_d2 = np.mean(stats[:, STAT_D2_MS]) - np.mean(stats[:, STAT_D2_MEAN]) ** 2
+    mobility = np.sqrt(var_d1 / activity)
+    complexity = np.sqrt(var_d2 / (var_d1 + 1e-12))
     return {
         "Hjorth_Activity": float(activity),
         "Hjorth_Mobility": float(mobility),
@@ -278,6 +287,17 @@ except Exception as e:
     transformer_model = None
     print(f"[ERROR] Failed to load Transformer model: {e}")
 
+# The models only make sense on band powers from the PSD backend they were trained on
+training_params = load_manifest(FEATURES_MANIFEST_PATH)["params"]
+if training_params and training_params.get("psd_method", "multitaper") != PSD_METHOD:
+    print(f"[ERROR] Models were trained on psd_method={training_params.get('psd_method', 'multitaper')!r} "
+          f"features ({FEATURES_MANIFEST_PATH}), but EEG_PSD_METHOD is {PSD_METHOD!r}; predictions will be off.")
+
+# Load the feature kernels (compiled once into Numba's on-disk cache) and build
+# the spectral plan for the live window, so the first prediction pays for neither
+warm_up_kernels()
+compute_band_tensor(np.zeros((1, WINDOW_SAMPLES)), SAMPLING_RATE, FREQUENCY_BANDS, method=PSD_METHOD)
+
 # Initialize a lock for Transformer model to handle concurrent access
 transformer_lock = asyncio.Lock()
 
@@ -0,0 +1,83 @@
+"""
+Preprocessed Signal Cache
+
+Band-passed, resampled recordings stored as float32 .npy files, so feature
+experiments skip decoding EEGLAB files and re-filtering/resampling them.
+
+Layout: <root>/<params hash>/ holds params.json and, per recording,
+  <name>.npy       float32 (n_channels, n_samples), opened as a read-only memmap
+                   (the float64 feature path still copies it into memory)
+  <name>-info.fif  the full measurement info (channel positions, digitization)
+  <name>.json      channel names/types, sampling rate, bad spans, and the size
+                   and mtime of the source files; written last, so a recording
+                   counts as cached only once all three files are complete.
+Changing any preprocessing parameter selects a different directory; changing
+a source file (size or mtime) invalidates its entry.
+"""
+
+import os
+import json
+import hashlib
+
+import numpy as np
+import mne
+
+from feature_store import atomic_save_npy, atomic_save_json, input_files_for
+
+SIGNAL_CACHE_VERSION = 1
+
+class PreprocessedCache:
+    def __init__(self, root, params):
+        key = hashlib.sha256(json.dumps([SIGNAL_CACHE_VERSION, params], sort_keys=True).encode("utf-8"))
+        self.dir = os.path.join(root, key.hexdigest()[:16])
+        os.makedirs(self.dir, exist_ok=True)
+        params_path = os.path.join(self.dir, "params.json")
+        if not os.path.exists(params_path):
+            atomic_save_json(params_path, params, indent=1, sort_keys=True)
+
+    def _paths(self, set_path):
+        name = os.path.splitext(os.path.basename(set_path))[0]
+        base = os.path.join(self.dir, name)
+        return f"{base}.npy", f"{base}-info.fif", f"{base}.json"
+
+    @staticmethod
+    def _sources(set_path):
+        sources = {}
+        for path in input_files_for(set_path):
+            st = os.stat(path)
+            sources[path] = [st.st_size, st.st_mtime_ns]
+        return sources
+
+    def load(self, set_path):
+        """(signal memmap, info, bad_spans), or None if absent or stale."""
+        data_path, info_path, meta_path = self._paths(set_path)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r") as fp:
+            meta = json.load(fp)
+        if meta["sources"] != self._sources(set_path):
+            return None
+        signal = np.load(data_path, mmap_mode="r")
+        info = mne.io.read_info(info_path, verbose=False)
+        return signal, info, [tuple(span) for span in meta["bad_spans"]]
+
+    def save(self, set_path, signal, info, bad_spans):
+        """
+        Store one recording; returns it as load() would, so a fresh entry and a
+        cache hit give identical inputs (the .fif keeps positions as float32).
+        """
+        data_path, info_path, meta_path = self._paths(set_path)
+        atomic_save_npy(data_path, np.asarray(signal, dtype=np.float32))
+        # write_info picks the format from the name, so the temporary keeps the -info.fif suffix
+        tmp_info = info_path.replace("-info.fif", f".{os.getpid()}.tmp-info.fif")
+        mne.io.write_info(tmp_info, info)
+        os.replace(tmp_info, info_path)
+        atomic_save_json(meta_path, {
+            "sources": self._sources(set_path),
+            "ch_names": info.ch_names,
+            "ch_types": info.get_channel_types(),
+            "sfreq": info["sfreq"],
+            "shape": list(signal.shape),
+            "bad_spans": [list(span) for span in bad_spans],
+        })
+        return self.load(set_path)
@@ -0,0 +1,295 @@
+"""
+Spectral Engine
+
+Batched power-spectral-density estimation shared by the EEG feature extractors
+(process_server.py offline, server.py live).
+
+A whole (n_epochs, n_channels, n_times) array goes through a single PSD pass,
+and band powers for every epoch and channel are read off the resulting spectrum
+tensor. Everything that depends only on the window geometry (tapers, taper
+weights, frequency grid, per-band bin slices) lives in a SpectralPlan that is
+built once per (n_times, sfreq, bandwidth, method) and kept in a small
+process-wide LRU cache.
+
+PSD backends (the ``method`` argument), from most to least expensive:
+  • "multitaper"  — DPSS multitaper, as mne.time_frequency.psd_array_multitaper
+  • "welch"       — Hamming-windowed segments averaged, as
+                    mne.time_frequency.psd_array_welch (256-sample segments)
+  • "periodogram" — one Hann-tapered rfft, as scipy.signal.periodogram
+The estimators differ in scale and variance, so features from different
+backends are not interchangeable; the offline pipeline records the backend in
+its manifest.
+
+Overlapping windows cut from one continuous signal can share Welch segments:
+when the window length and hop are multiples of WELCH_N_FFT, every window is a
+run of the same segments, so segment_band_powers transforms each segment once
+and window_band_powers averages them per window (Welch averages segment
+periodograms, and band powers are linear in the PSD). The spectral cost is
+then that of the signal, however much the windows overlap.
+
+Channel-pair connectivity (magnitude-squared coherence and phase-locking
+value, per band) is estimated from the same Welch segments: a
+ConnectivityAccumulator transforms a batch of segments once and gets the cross
+spectra of all channel pairs from one batched matrix product per frequency.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+import mne
+from scipy.fft import rfft, rfftfreq
+from scipy.signal import get_window
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Max number of distinct window geometries kept in memory per process
+PLAN_CACHE_SIZE = 8
+
+PSD_METHODS = ("multitaper", "welch", "periodogram")
+# Welch segment length in samples (mne.time_frequency.psd_array_welch default n_fft)
+WELCH_N_FFT = 256
+
+#############################################
+# 1) SPECTRAL PLAN (cached setup work)
+#############################################
+class SpectralPlan:
+    """
+    Precomputed PSD setup for one window geometry and backend.
+
+    "multitaper" matches mne.time_frequency.psd_array_multitaper defaults
+    (half-bandwidth 4 when bandwidth is None, low_bias tapers, non-adaptive,
+    'length' normalisation, DC removed). "welch" matches
+    mne.time_frequency.psd_array_welch defaults (Hamming window, no overlap,
+    per-segment DC removal, density scaling); "periodogram" matches
+    scipy.signal.periodogram with a Hann window. bandwidth only applies to
+    "multitaper".
+    """
+    def __init__(self, n_times, sfreq, bandwidth=None, method="multitaper"):
+        if method not in PSD_METHODS:
+            raise ValueError(f"Unknown PSD method '{method}', expected one of {PSD_METHODS}")
+        self.n_times = n_times
+        self.sfreq = sfreq
+        self.bandwidth = bandwidth
+        self.method = method
+        # scipy.fft keeps its own per-length plan cache, so a fixed n_fft means
+        # every call after the first reuses the same FFT plan.
+        self.n_fft = min(WELCH_N_FFT, n_times) if method == "welch" else n_times
+        self.freqs = rfftfreq(self.n_fft, 1.0 / sfreq)
+        self._band_slices = {}
+
+        if method == "multitaper":
+            self._init_multitaper(bandwidth)
+        else:
+            window = "hamming" if method == "welch" else "hann"
+            self.window = get_window(window, self.n_fft)
+            # Density scaling with the one-sided factor 2 folded in
+            self.scale = float(2.0 / (sfreq * np.sum(self.window ** 2)))
+        self._float32 = None
+
+    def _init_multitaper(self, bandwidth):
+        n_times, sfreq = self.n_times, self.sfreq
+        if bandwidth is not None:
+            half_nbw = float(bandwidth) * n_times / (2.0 * sfreq)
+        else:
+            half_nbw = 4.0
+        if half_nbw < 0.5:
+            raise ValueError(
+                f"bandwidth value {bandwidth} yields a normalized half-bandwidth of "
+                f"{half_nbw} < 0.5, use a value of at least {sfreq / n_times}"
+            )
+        self.tapers, eigvals = mne.time_frequency.dpss_windows(
+            n_times, half_nbw, int(2 * half_nbw), sym=False, low_bias=True
+        )
+        # |w_k|^2 taper weights, already scaled by the one-sided factor 2 / sum(|w|^2)
+        self.weights = 2.0 * eigvals / np.sum(eigvals)
+
+    def band_slices(self, bands):
+        """Contiguous bin slices equivalent to (freqs >= fmin) & (freqs <= fmax)."""
+        key = tuple(bands.items())
+        slices = self._band_slices.get(key)
+        if slices is None:
+            slices = [
+                slice(np.searchsorted(self.freqs, fmin, side="left"),
+                      np.searchsorted(self.freqs, fmax, side="right"))
+                for fmin, fmax in bands.values()
+            ]
+            self._band_slices[key] = slices
+        return slices
+
+    def _windows(self, dtype):
+        """Tapers/window and taper weights in the working precision (float32 copies made once)."""
+        tapers = self.tapers if self.method == "multitaper" else self.window
+        weights = self.weights if self.method == "multitaper" else None
+        if dtype != np.float32:
+            return tapers, weights
+        if self._float32 is None:
+            self._float32 = (tapers.astype(np.float32),
+                             weights.astype(np.float32) if weights is not None else None)
+        return self._float32
+
+    def psd(self, data):
+        """
+        PSD over the last axis -> data.shape[:-1] + (n_freqs,). float32 input
+        is transformed and accumulated in float32; anything else in float64.
+        """
+        dtype = np.float32 if data.dtype == np.float32 else np.float64
+        data = np.asarray(data, dtype=dtype)
+        tapers, weights = self._windows(dtype)
+        if self.method == "multitaper":
+            psd = self._psd_multitaper(data, tapers, weights)
+        elif self.method == "welch":
+            # Non-overlapping segments; trailing samples that do not fill one are dropped
+            n_segments = data.shape[-1] // self.n_fft
+            x = data[..., :n_segments * self.n_fft].reshape(data.shape[:-1] + (n_segments, self.n_fft))
+            x = x - np.mean(x, axis=-1, keepdims=True)
+            spec = rfft(x * tapers, axis=-1)
+            psd = self.scale * np.mean(spec.real ** 2 + spec.imag ** 2, axis=-2)
+        else:
+            x = data - np.mean(data, axis=-1, keepdims=True)
+            spec = rfft(x * tapers, axis=-1)
+            psd = self.scale * (spec.real ** 2 + spec.imag ** 2)
+        # One-sided transform: DC (and Nyquist for even n_fft) are not doubled
+        psd[..., 0] /= 2.0
+        if self.n_fft % 2 == 0:
+            psd[..., -1] /= 2.0
+        return psd
+
+    def _psd_multitaper(self, data, tapers, weights):
+        x = data - np.mean(data, axis=-1, keepdims=True)
+        psd = np.zeros(x.shape[:-1] + (len(self.freqs),), dtype=data.dtype)
+        # One taper at a time keeps the complex intermediate at a single spectrum
+        for taper, weight in zip(tapers, weights):
+            spec = rfft(x * taper, n=self.n_fft, axis=-1)
+            psd += weight * (spec.real ** 2 + spec.imag ** 2)
+        return psd
+
+@lru_cache(maxsize=PLAN_CACHE_SIZE)
+def get_spectral_plan(n_times, sfreq, bandwidth=None, method="multitaper"):
+    return SpectralPlan(n_times, sfreq, bandwidth, method)
+
+#############################################
+# 2) BATCHED PSD
+#############################################
+def compute_psd_batch(data, sfreq, bandwidth=None, method="multitaper"):
+    """
+    PSD over the last axis of ``data`` in one call.
+
+    Returns psd with shape data.shape[:-1] + (n_freqs,) and the frequency grid.
+    """
+    plan = get_spectral_plan(data.shape[-1], sfreq, bandwidth, method)
+    return plan.psd(data), plan.freqs
+
+#############################################
+# 3) BAND POWERS
+#############################################
+def band_power_tensor(psd, freqs, bands):
+    """
+    Mean PSD inside each band.
+
+    Returns an array of shape psd.shape[:-1] + (n_bands,), bands in dict order.
+    """
+    out = np.empty(psd.shape[:-1] + (len(bands),), dtype=psd.dtype)
+    for b, (fmin, fmax) in enumerate(bands.values()):
+        idx = slice(np.searchsorted(freqs, fmin, side="left"),
+                    np.searchsorted(freqs, fmax, side="right"))
+        out[..., b] = np.mean(psd[..., idx], axis=-1)
+    return out
+
+def compute_band_tensor(data, sfreq, bands, bandwidth=None, method="multitaper"):
+    """
+    Band powers straight from signals, using the cached plan's band slices.
+
+    Returns an array of shape data.shape[:-1] + (n_bands,), bands in dict order.
+    """
+    plan = get_spectral_plan(data.shape[-1], sfreq, bandwidth, method)
+    psd = plan.psd(data)
+    out = np.empty(psd.shape[:-1] + (len(bands),), dtype=psd.dtype)
+    for b, idx in enumerate(plan.band_slices(bands)):
+        out[..., b] = np.mean(psd[..., idx], axis=-1)
+    return out
+
+#############################################
+# 4) OVERLAPPING WINDOWS (SHARED WELCH SEGMENTS)
+#############################################
+def shares_segments(window_len, hop, method):
+    """Whether windows of window_len samples every hop samples can share Welch segment FFTs."""
+    return (method == "welch" and window_len >= WELCH_N_FFT
+            and window_len % WELCH_N_FFT == 0 and hop % WELCH_N_FFT == 0)
+
+def segment_band_powers(signal, sfreq, bands):
+    """
+    Welch band powers of each consecutive WELCH_N_FFT-sample segment of a
+    continuous signal -> signal.shape[:-1] + (n_segments, n_bands). A trailing
+    partial segment is dropped.
+    """
+    plan = get_spectral_plan(WELCH_N_FFT, sfreq, None, "welch")
+    n_segments = signal.shape[-1] // WELCH_N_FFT
+    segments = signal[..., :n_segments * WELCH_N_FFT].reshape(signal.shape[:-1] + (n_segments, WELCH_N_FFT))
+    psd = plan.psd(segments)
+    out = np.empty(psd.shape[:-1] + (len(bands),), dtype=psd.dtype)
+    for b, idx in enumerate(plan.band_slices(bands)):
+        out[..., b] = np.mean(psd[..., idx], axis=-1)
+    return out
+
+def window_band_powers(seg_bands, starts, window_len):
+    """
+    Welch band powers of the windows [s, s + window_len) of the signal behind
+    seg_bands (from segment_band_powers), for start samples s on the segment
+    grid -> (n_windows,) + seg_bands.shape[:-2] + (n_bands,). Matches
+    compute_band_tensor(..., method="welch") on the cut windows up to rounding.
+    """
+    n_per = window_len // WELCH_N_FFT
+    runs = sliding_window_view(seg_bands, n_per, axis=-2)  # (..., n_runs, n_bands, n_per)
+    out = np.mean(runs[..., np.asarray(starts) // WELCH_N_FFT, :, :], axis=-1)
+    return np.moveaxis(out, -2, 0)
+
+#############################################
+# 5) CHANNEL-PAIR CONNECTIVITY
+#############################################
+class ConnectivityAccumulator:
+    """
+    Running cross-spectral sums over Welch segments (WELCH_N_FFT samples,
+    Hamming window, DC removed) of one recording, for per-band coherence and
+    phase-locking value between all channel pairs. Segments can be added in
+    any number of batches; the estimate uses all of them.
+    """
+    def __init__(self, n_channels, sfreq):
+        self.plan = get_spectral_plan(WELCH_N_FFT, sfreq, None, "welch")
+        n_freqs = len(self.plan.freqs)
+        self.cross = np.zeros((n_freqs, n_channels, n_channels), dtype=np.complex128)
+        self.phase = np.zeros((n_freqs, n_channels, n_channels), dtype=np.complex128)
+        self.n_segments = 0
+
+    def add(self, segments):
+        """segments: (n_segments, n_channels, WELCH_N_FFT)."""
+        if len(segments) == 0:
+            return
+        tapers, _ = self.plan._windows(np.float32 if segments.dtype == np.float32 else np.float64)
+        x = segments - np.mean(segments, axis=-1, keepdims=True)
+        spec = np.ascontiguousarray(rfft(x * tapers, axis=-1).transpose(2, 1, 0))  # (n_freqs, n_channels, n_segments)
+        # All channel pairs at once: (n_channels, n_segments) @ (n_segments, n_channels) per frequency
+        self.cross += spec @ spec.conj().transpose(0, 2, 1)
+        unit = spec / np.maximum(np.abs(spec), np.finfo(spec.real.dtype).tiny)
+        self.phase += unit @ unit.conj().transpose(0, 2, 1)
+        self.n_segments += len(segments)
+
+    def band_connectivity(self, bands):
+        """
+        (coherence, plv), each (n_bands, n_channels, n_channels) float32, bands
+        in dict order: per-frequency magnitude-squared coherence
+        |S_xy|^2 / (S_xx S_yy) and PLV |mean(exp(i (phi_x - phi_y)))|,
+        averaged over each band's bins. Diagonals are 1.
+        """
+        if self.n_segments == 0:
+            raise ValueError("No segments added.")
+        power = np.real(np.diagonal(self.cross, axis1=1, axis2=2))
+        denom = power[:, :, np.newaxis] * power[:, np.newaxis, :]
+        coherence = np.abs(self.cross) ** 2 / np.where(denom > 0, denom, np.inf)
+        plv = np.abs(self.phase) / self.n_segments
+        n_channels = self.cross.shape[1]
+        out_coh = np.empty((len(bands), n_channels, n_channels), dtype=np.float32)
+        out_plv = np.empty_like(out_coh)
+        for b, idx in enumerate(self.plan.band_slices(bands)):
+            out_coh[b] = np.mean(coherence[idx], axis=0)
+            out_plv[b] = np.mean(plv[idx], axis=0)
+        return out_coh, out_plv
+
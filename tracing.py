@@ -0,0 +1,142 @@
+"""
+Stage Tracing
+
+Lightweight per-stage instrumentation for the offline feature pipeline.
+
+A StageTrace accumulates, per named stage, wall time, CPU time (process-wide,
+so BLAS/Numba threads are included) and the memory seen at the end of the
+stage. Code marks stages with ``with stage("filter"):``; outside an active
+trace that is a no-op, and inside one it costs two clock reads and one
+memory read, so tracing can stay on in production runs.
+
+Memory is the peak RSS since the trace started where the high-water mark can
+be reset (Linux: /proc/self/clear_refs, read back as VmHWM), reported as
+peak_rss_mb; the first stage whose value jumps is the one that set the peak.
+The process_server workers are reused across subjects, so without a reset the
+lifetime peak would carry over from earlier subjects: elsewhere the current
+RSS at the end of each stage is sampled instead (psutil), reported as rss_mb.
+"""
+
+import time
+import json
+from contextlib import contextmanager, nullcontext
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+_active_trace = None
+
+#############################################
+# 1) MEASUREMENTS
+#############################################
+def reset_peak_rss():
+    """Reset the process RSS high-water mark; False where that is not possible."""
+    try:
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    """Peak RSS in MB since the last reset_peak_rss (VmHWM), or None off Linux."""
+    try:
+        with open("/proc/self/status", "r") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def current_rss_mb():
+    """Current RSS in MB, or None without psutil."""
+    return psutil.Process().memory_info().rss / 1024**2 if psutil is not None else None
+
+class StageTrace:
+    def __init__(self):
+        self.stages = {}
+        # "peak_rss_mb" (high-water mark since this trace started) or "rss_mb" (sampled)
+        self.rss_key = "peak_rss_mb" if reset_peak_rss() and peak_rss_mb() is not None else "rss_mb"
+        self._wall0 = time.perf_counter()
+        self._cpu0 = time.process_time()
+
+    def rss_mb(self):
+        return peak_rss_mb() if self.rss_key == "peak_rss_mb" else current_rss_mb()
+
+    @contextmanager
+    def stage(self, name):
+        wall0 = time.perf_counter()
+        cpu0 = time.process_time()
+        try:
+            yield
+        finally:
+            entry = self.stages.setdefault(name, {"wall_s": 0.0, "cpu_s": 0.0, "calls": 0, self.rss_key: None})
+            entry["wall_s"] += time.perf_counter() - wall0
+            entry["cpu_s"] += time.process_time() - cpu0
+            entry["calls"] += 1
+            rss = self.rss_mb()
+            if rss is not None:
+                entry[self.rss_key] = max(entry[self.rss_key] or 0.0, rss)
+
+    def summary(self):
+        """JSON-ready totals and per-stage entries (stages in first-use order)."""
+        return {
+            "wall_s": time.perf_counter() - self._wall0,
+            "cpu_s": time.process_time() - self._cpu0,
+            self.rss_key: self.rss_mb(),
+            "stages": self.stages,
+        }
+
+#############################################
+# 2) ACTIVE TRACE
+#############################################
+def start_trace():
+    global _active_trace
+    _active_trace = StageTrace()
+    return _active_trace
+
+def stop_trace():
+    """Deactivate the current trace and return its summary (None if none was active)."""
+    global _active_trace
+    trace, _active_trace = _active_trace, None
+    return trace.summary() if trace is not None else None
+
+def stage(name):
+    """Context manager timing `name` in the active trace; a no-op when none is active."""
+    if _active_trace is None:
+        return nullcontext()
+    return _active_trace.stage(name)
+
+#############################################
+# 3) TRACE FILE & RUN SUMMARY
+#############################################
+def append_trace(path, record):
+    """Append one subject record as a JSON line."""
+    with open(path, "a") as fp:
+        fp.write(json.dumps(record) + "\n")
+
+def print_run_summary(records, top=5):
+    """Slowest subjects and the stages that cost the most wall time over the run."""
+    if not records:
+        return
+    rss_key = "peak_rss_mb" if "peak_rss_mb" in records[0] else "rss_mb"
+    rss_label = "peak RSS MB" if rss_key == "peak_rss_mb" else "end RSS MB"
+    print(f"[INFO] Slowest {min(top, len(records))} subjects (wall s / cpu s / {rss_label}, slowest stage):")
+    for rec in sorted(records, key=lambda r: r["wall_s"], reverse=True)[:top]:
+        slowest = max(rec["stages"].items(), key=lambda kv: kv[1]["wall_s"], default=(None, None))[0]
+        rss = f"{rec[rss_key]:.0f}" if rec.get(rss_key) is not None else "n/a"
+        print(f"    {rec['subject']:<12} {rec['wall_s']:8.2f} {rec['cpu_s']:8.2f} {rss:>8}   {slowest}")
+
+    totals = {}
+    for rec in records:
+        for name, entry in rec["stages"].items():
+            tot = totals.setdefault(name, {"wall_s": 0.0, "cpu_s": 0.0})
+            tot["wall_s"] += entry["wall_s"]
+            tot["cpu_s"] += entry["cpu_s"]
+    run_wall = sum(rec["wall_s"] for rec in records) or 1e-9
+    print("[INFO] Stage totals over all subjects (wall s / cpu s / share of wall):")
+    for name, tot in sorted(totals.items(), key=lambda kv: kv[1]["wall_s"], reverse=True):
+        print(f"    {name:<16} {tot['wall_s']:8.2f} {tot['cpu_s']:8.2f} {100 * tot['wall_s'] / run_wall:6.1f}%")